@@ -1,8 +1,100 @@
 import click
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 from sklearn import datasets, svm, metrics
+from sklearn.metrics.pairwise import pairwise_kernels
 from sklearn.model_selection import train_test_split
 from datetime import datetime, timezone
 
+# Hyperparameters that each kernel depends on, configurations that agree on them share a Gram matrix
+KERNEL_PARAMS = {
+    "linear": (),
+    "rbf": ("gamma",),
+    "poly": ("gamma", "degree", "coef0"),
+    "sigmoid": ("gamma", "coef0"),
+}
+
+
+def katib_timestamp() -> str:
+    """Current UTC time in the format of Katib's StdOut metrics collector."""
+    return (
+        datetime.now().astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+        + "Z"
+    )
+
+
+def kernel_key(config: dict) -> tuple:
+    """Kernel and the hyperparameters its Gram matrix depends on."""
+    return (config["kernel"],) + tuple(
+        config[param] for param in KERNEL_PARAMS[config["kernel"]]
+    )
+
+
+def gram_matrices(config: dict, X_train, X_val, X_test) -> tuple:
+    """Kernel values of the training, validation and test set against the training set.
+
+    Args:
+        config (dict): Hyperparameters, see `kernel_key`.
+        X_train, X_val, X_test: Training, validation and test features.
+
+    Returns:
+        tuple: Matrices of shape (len(X), len(X_train)) for each of the three sets.
+    """
+    params = {param: config[param] for param in KERNEL_PARAMS[config["kernel"]]}
+    return tuple(
+        pairwise_kernels(X, X_train, metric=config["kernel"], **params)
+        for X in (X_train, X_val, X_test)
+    )
+
+
+def evaluate_precomputed(config: dict, grams: tuple, y_train, y_val, y_test) -> dict:
+    """Fits an SVM on a precomputed Gram matrix and returns the configuration with its accuracies."""
+    K_train, K_val, K_test = grams
+    clf = svm.SVC(C=config["c"], kernel="precomputed")
+    clf.fit(K_train, y_train)
+    return {
+        **config,
+        "train_accuracy": metrics.accuracy_score(y_train, clf.predict(K_train)),
+        "val_accuracy": metrics.accuracy_score(y_val, clf.predict(K_val)),
+        "test_accuracy": metrics.accuracy_score(y_test, clf.predict(K_test)),
+    }
+
+
+def evaluate_configs(
+    configs: list, workers: int, X_train, X_val, X_test, y_train, y_val, y_test
+) -> list:
+    """Evaluates hyperparameter configurations on a thread pool.
+
+    Gram matrices are computed once per kernel and kernel hyperparameters, and shared by all
+    configurations that only differ in C. libsvm and the kernel computations release the GIL,
+    so threads run in parallel without copying the matrices.
+
+    Returns:
+        list: The configurations with their train, validation and test accuracies, in order.
+    """
+    keys = [kernel_key(config) for config in configs]
+    unique = {key: config for key, config in zip(keys, configs)}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        grams = dict(
+            zip(
+                unique,
+                executor.map(
+                    lambda config: gram_matrices(config, X_train, X_val, X_test),
+                    unique.values(),
+                ),
+            )
+        )
+        return list(
+            executor.map(
+                lambda config, key: evaluate_precomputed(
+                    config, grams[key], y_train, y_val, y_test
+                ),
+                configs,
+                keys,
+            )
+        )
+
 
 @click.command()
 @click.option("--gamma", default=0.001, type=float)
@@ -10,7 +102,34 @@ from datetime import datetime, timezone
 @click.option("--kernel", default="rbf", type=str)
 @click.option("--degree", default=3, type=int)
 @click.option("--coef0", default=0.0, type=float)
-def train_svm(gamma: float, c: float, kernel: str, degree: int, coef0: float) -> None:
+@click.option(
+    "--rungs",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of successive-halving rungs, 4 trains on 12.5%, 25%, 50% and 100%.",
+)
+@click.option(
+    "--configs",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="JSON file with a list of hyperparameter configurations to evaluate instead.",
+)
+@click.option(
+    "--workers",
+    default=0,
+    type=int,
+    help="Number of configurations evaluated at once with --configs, 0 for all cores.",
+)
+def train_svm(
+    gamma: float,
+    c: float,
+    kernel: str,
+    degree: int,
+    coef0: float,
+    rungs: int,
+    configs: str,
+    workers: int,
+) -> None:
     """Train an SVM model on the MNIST dataset using specified hyperparameters.
 
     Args:
@@ -23,6 +142,16 @@ def train_svm(gamma: float, c: float, kernel: str, degree: int, coef0: float) ->
                       kernels.
         coef0 (float): Independent term in kernel function. It is only significant in 'poly'
                        and 'sigmoid'.
+        rungs (int): Number of rungs. The model is trained on a subset of the training set
+                     that doubles with every rung, up to the full set in the last one, and
+                     Train- and Validation-Accuracy are printed after each. Katib's early
+                     stopping can then stop bad trials before they train on all data.
+        configs (str): Path to a JSON list of objects with any of the keys gamma, c, kernel,
+                       degree and coef0, the options above are the defaults of missing keys.
+                       All configurations are evaluated in this process on the same split,
+                       and the metrics of the one with the best validation accuracy are
+                       reported to katib, with its index in the list as Best-Config.
+        workers (int): Size of the thread pool the configurations are evaluated on.
     """
     # Load the MNIST dataset
     digits = datasets.load_digits()
@@ -35,29 +164,88 @@ def train_svm(gamma: float, c: float, kernel: str, degree: int, coef0: float) ->
         X_temp, y_temp, test_size=0.5, random_state=42
     )
 
-    # Create the SVM classifier with specified hyperparameters
-    clf = svm.SVC(C=c, kernel=kernel, gamma=gamma, degree=degree, coef0=coef0)
+    if configs is not None:
+        if rungs > 1:
+            raise click.UsageError("--rungs is not supported together with --configs.")
+        defaults = {
+            "gamma": gamma,
+            "c": c,
+            "kernel": kernel,
+            "degree": degree,
+            "coef0": coef0,
+        }
+        with open(configs) as f:
+            configs = json.load(f)
+        for i, config in enumerate(configs):
+            unknown = sorted(set(config) - set(defaults))
+            if unknown:
+                # a typo would otherwise silently run with the default value
+                raise click.UsageError(
+                    f"Unknown keys {unknown} in configuration {i}, expected any of {list(defaults)}."
+                )
+        configs = [{**defaults, **config} for config in configs]
+        for config in configs:
+            if config["kernel"] not in KERNEL_PARAMS:
+                raise click.UsageError(
+                    f"Unknown kernel {config['kernel']}, expected one of {list(KERNEL_PARAMS)}."
+                )
+
+        results = evaluate_configs(
+            configs,
+            workers or os.cpu_count(),
+            X_train,
+            X_val,
+            X_test,
+            y_train,
+            y_val,
+            y_test,
+        )
+        for result in results:
+            print(json.dumps(result))
 
-    # Train the model
-    clf.fit(X_train, y_train)
+        # Print the best configuration to std out for katib, together with its position in the list
+        # so that the reported metrics can be traced back to it
+        best_index = max(range(len(results)), key=lambda i: results[i]["val_accuracy"])
+        best = results[best_index]
+        print(json.dumps({"best_config": best_index, **best}))
+        timestamp = katib_timestamp()
+        print(f"{timestamp} Best-Config={best_index}")
+        print(f"{timestamp} Train-Accuracy={best['train_accuracy']:.2f}")
+        print(f"{timestamp} Validation-Accuracy={best['val_accuracy']:.2f}")
+        print(f"{timestamp} Test-Accuracy={best['test_accuracy']:.2f}")
+        return
 
-    # Make predictions and evaluate on the training set
-    y_train_pred = clf.predict(X_train)
-    train_accuracy = metrics.accuracy_score(y_train, y_train_pred)
+    # The training set is already shuffled, every rung trains on a larger prefix of it
+    for rung in range(rungs):
+        n_samples = round(len(X_train) / 2 ** (rungs - 1 - rung))
+        X_rung, y_rung = X_train[:n_samples], y_train[:n_samples]
 
-    # Make predictions and evaluate on the validation set
-    y_val_pred = clf.predict(X_val)
-    val_accuracy = metrics.accuracy_score(y_val, y_val_pred)
+        # Create the SVM classifier with specified hyperparameters
+        clf = svm.SVC(C=c, kernel=kernel, gamma=gamma, degree=degree, coef0=coef0)
+
+        # Train the model
+        clf.fit(X_rung, y_rung)
+
+        # Make predictions and evaluate on the training set
+        y_train_pred = clf.predict(X_rung)
+        train_accuracy = metrics.accuracy_score(y_rung, y_train_pred)
+
+        # Make predictions and evaluate on the validation set
+        y_val_pred = clf.predict(X_val)
+        val_accuracy = metrics.accuracy_score(y_val, y_val_pred)
+
+        if rung < rungs - 1:
+            # Intermediate metrics for katib's early stopping
+            timestamp = katib_timestamp()
+            print(f"{timestamp} Train-Accuracy={train_accuracy:.2f}")
+            print(f"{timestamp} Validation-Accuracy={val_accuracy:.2f}", flush=True)
 
     # Make predictions and evaluate on the test set
     y_test_pred = clf.predict(X_test)
     test_accuracy = metrics.accuracy_score(y_test, y_test_pred)
 
     # Print to std out for katib
-    timestamp = (
-        datetime.now().astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
-        + "Z"
-    )
+    timestamp = katib_timestamp()
     print(f"{timestamp} Train-Accuracy={train_accuracy:.2f}")
     print(f"{timestamp} Validation-Accuracy={val_accuracy:.2f}")
     print(f"{timestamp} Test-Accuracy={test_accuracy:.2f}")
@@ -0,0 +1,107 @@
+import click
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s:%(levelname)s:%(name)s:%(message)s")
+logger = logging.getLogger(__name__)
+
+CHEM_UTIL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chem-util.py')
+
+
+def replicate(input_data: str, n_rows: int, output_data: str, id_col: str = 'ID') -> None:
+    """Writes a csv.zip of n_rows by repeating the rows of the input, with IDs made unique per repetition."""
+    df = pd.read_csv(input_data, index_col=0, compression='zip')
+    rows = np.arange(n_rows)
+    out = df.iloc[rows % len(df)].reset_index(drop=True)
+    out[id_col] = out[id_col].astype(str) + '_' + (rows // len(df)).astype(str)
+    out.to_csv(output_data, compression='zip')
+
+
+def run_stage(args: List[str]) -> Dict:
+    """Runs a chem-util command and returns its wall time and peak RSS."""
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, CHEM_UTIL] + args)
+    # wait4 gives the resource usage of this child (and its own children) only
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux, the largest process of the tree counts
+    return {'seconds': round(seconds, 3), 'max_rss_mb': round(usage.ru_maxrss / 1024, 1),
+            'returncode': process.returncode}
+
+
+def stages(data: str, work_dir: str, fp_bits: int, jobs: int, chunk_size: int, n_trees: int, n_jobs: int) -> Dict:
+    """Arguments of the chem-util commands in the order the pipeline runs them."""
+    features = os.path.join(work_dir, f'features_{fp_bits}.npz')
+    train, test = os.path.join(work_dir, 'train_idx.npy'), os.path.join(work_dir, 'test_idx.npy')
+    model = os.path.join(work_dir, f'model_{fp_bits}.joblib')
+    preprocess = ['preprocess', '-i', data, '-o', features, '-n', str(fp_bits), '-j', str(jobs)]
+    if chunk_size:
+        preprocess += ['-k', str(chunk_size)]
+    return {
+        'preprocess': preprocess,
+        'split': ['split', '-i', features, '-o', train, '-t', test, '--indices-only'],
+        'train': ['train', '-i', features, '-x', train, '-o', model, '-n', str(n_trees), '-j', str(n_jobs)],
+        'evaluate': ['evaluate', '-i', features, '-x', test, '-m', model,
+                     '-o', os.path.join(work_dir, f'metrics_{fp_bits}.txt')],
+    }
+
+
+@click.command()
+@click.option('--input-data', '-i', help="Path to the dataset to replicate (csv.zip).", required=True, type=str)
+@click.option('--output-report', '-o', help="Path to store the results as JSON.", required=False, type=str)
+@click.option('--rows', '-r', help="Size of a synthetic dataset, can be repeated.", multiple=True, type=int,
+              default=[10_000, 100_000, 1_000_000])
+@click.option('--fp-bits', '-n', help="Number of the fingerprint bits, can be repeated.", multiple=True, type=int,
+              default=[1024])
+@click.option('--work-dir', '-w', help="Directory for the datasets and outputs, kept to reuse the datasets. "
+                                       "Defaults to a temporary directory.", required=False, type=str)
+@click.option('--jobs', '-j', help="Worker processes of `preprocess`.", type=int, default=1)
+@click.option('--chunk-size', '-k', help="Run `preprocess` streaming in chunks of this many rows.", required=False,
+              type=int)
+@click.option('--n-trees', help="Number of trees of `train`.", type=int, default=16)
+@click.option('--n-jobs', help="Number of trees of `train` fitted in parallel.", type=int, default=1)
+def benchmark(input_data, output_report, rows, fp_bits, work_dir, jobs, chunk_size, n_trees, n_jobs):
+    """Runs preprocess, split, train and evaluate on replicated datasets and reports wall time and peak RSS."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = work_dir or tmp_dir
+        os.makedirs(work_dir, exist_ok=True)
+        results = []
+        for n_rows in rows:
+            data_dir = os.path.join(work_dir, str(n_rows))
+            os.makedirs(data_dir, exist_ok=True)
+            data = os.path.join(data_dir, 'data.csv.zip')
+            if not os.path.exists(data):
+                logger.info(f"Replicating {input_data} to {n_rows} rows.")
+                replicate(input_data, n_rows, data)
+            for bits in fp_bits:
+                for stage, args in stages(data, data_dir, bits, jobs, chunk_size, n_trees, n_jobs).items():
+                    logger.info(f"Running {stage} on {n_rows} rows with {bits} bits.")
+                    result = {'rows': n_rows, 'fp_bits': bits, 'stage': stage, **run_stage(args)}
+                    results.append(result)
+                    logger.info(f"{result}")
+                    if result['returncode'] != 0:
+                        logger.error(f"{stage} failed, skipping the remaining stages.")
+                        break
+
+    print(pd.DataFrame(results).to_string(index=False))
+    if output_report:
+        report = {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+                  'options': {'jobs': jobs, 'chunk_size': chunk_size, 'n_trees': n_trees, 'n_jobs': n_jobs},
+                  'results': results}
+        with open(output_report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,281 @@
+import asyncio
+import click
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import Executor, ThreadPoolExecutor
+from itertools import cycle, islice
+from typing import Awaitable, Callable, Dict, List, Tuple
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+from src.encoding import DENSE, INDICES, PACKED
+from src.executors import EXECUTORS, THREAD
+from src.features import get_cfps_batch
+from src.forest import FlatForest
+
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s:%(levelname)s:%(name)s:%(message)s")
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = 'model'
+FUSED = 'fused'
+# split deployments (transformer -> predictor) by the encoding of the fingerprints between them
+SPLIT = {'split-dense': DENSE, 'split-indices': INDICES, 'split-packed': PACKED}
+SCENARIOS = list(SPLIT) + [FUSED]
+IN_PROCESS = 'in-process'
+HTTP = 'http'
+
+
+def train_model(smiles: List[str], target: np.ndarray, n_bits: int, n_trees: int, path: str, flat: bool) -> None:
+    """Trains a random forest on all molecules and stores it as joblib, or flattened with `flat`."""
+    logger.info(f'Fitting a RandomForestClassifier model with {n_trees} trees on {len(smiles)} molecules.')
+    clf = RandomForestClassifier(n_estimators=n_trees, n_jobs=-1, random_state=42)
+    clf.fit(get_cfps_batch(smiles, nBits=n_bits), target)
+    # served with the n_jobs of a model from `chem-util.py train`, not fanned out to a joblib pool per request
+    clf.set_params(n_jobs=None)
+    if flat:
+        FlatForest.from_sklearn(clf).save(path)
+    else:
+        joblib.dump(clf, path)
+
+
+def summarize(latencies: List[float], seconds: float, batch_size: int, errors: int) -> Dict:
+    """Throughput and latency percentiles (in ms) of one run."""
+    ms = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99]) if len(ms) else (np.nan,) * 3
+    return {'requests': len(latencies), 'errors': errors, 'seconds': round(seconds, 3),
+            'requests_per_s': round(len(latencies) / seconds, 1),
+            'molecules_per_s': round(len(latencies) * batch_size / seconds, 1),
+            'p50_ms': round(float(p50), 2), 'p95_ms': round(float(p95), 2), 'p99_ms': round(float(p99), 2)}
+
+
+async def replay_in_process(call: Callable[[List[str]], Awaitable], batches: List[List[str]],
+                            concurrency: int) -> tuple:
+    """Sends the batches from `concurrency` concurrent clients on one event loop."""
+    queue = iter(batches)
+    latencies, errors = [], 0
+
+    async def client():
+        nonlocal errors
+        for batch in queue:
+            start = time.perf_counter()
+            try:
+                await call(batch)
+            except Exception as e:
+                errors += 1
+                logger.debug(f'Request failed: {e}')
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+
+def replay_http(url: str, batches: List[List[str]], concurrency: int) -> tuple:
+    """Posts the batches from `concurrency` client threads."""
+    def post(batch):
+        request = urllib.request.Request(url, data=json.dumps({'instances': batch}).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+        except urllib.error.URLError as e:
+            logger.debug(f'Request failed: {e}')
+            return None
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(post, batches))
+    seconds = time.perf_counter() - start
+    latencies = [x for x in results if x is not None]
+    return latencies, len(results) - len(latencies), seconds
+
+
+def in_process_call(scenario: str, n_bits: int, options: Dict) -> Tuple[Callable[[List[str]], Awaitable],
+                                                                         List[Executor]]:
+    """Builds the models of a scenario in this process and returns a coroutine function serving one request, and
+    the pools of the models, to be shut down after the run.
+
+    Payloads are serialized to JSON and back wherever they would cross the network, so only the HTTP stack is left
+    out of the measurement.
+    """
+    from src.serving import MolClassifier, MolPredictor, MolTransformer
+
+    if scenario == FUSED:
+        classifier = MolClassifier(MODEL_NAME, n_bits=n_bits, **options)
+
+        async def call(smiles):
+            payload = json.loads(json.dumps({'instances': smiles}))
+            return json.dumps(await classifier.predict(payload))
+        return call, [classifier.executor]
+
+    transformer = MolTransformer(MODEL_NAME, predictor_host='', n_bits=n_bits, encoding=SPLIT[scenario],
+                                 lru_size=options['lru_size'], workers=options['workers'],
+                                 executor=options['executor'])
+    predictor = MolPredictor(MODEL_NAME, max_batch_size=options['max_batch_size'],
+                             workers=options['workers'], executor=options['executor'])
+
+    async def call(smiles):
+        payload = await transformer.preprocess(json.loads(json.dumps({'instances': smiles})))
+        payload = json.loads(json.dumps(payload))
+        return json.dumps(transformer.postprocess(await predictor.predict(payload)))
+    return call, [transformer.featurizer.executor, predictor.executor]
+
+
+def wait_until_ready(url: str, process: subprocess.Popen, timeout: float = 120) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise click.ClickException(f'Model server exited with code {process.returncode}.')
+        try:
+            with urllib.request.urlopen(url) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.5)
+    raise click.ClickException(f'Model server at {url} was not ready after {timeout}s.')
+
+
+def start_servers(scenario: str, n_bits: int, options: Dict, port: int) -> tuple:
+    """Starts `model-serving.py` on localhost and returns the processes and the URL to send requests to."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model-serving.py')
+
+    def serve(command, http_port, *args):
+        process = subprocess.Popen([sys.executable, script, command, '--model_name', MODEL_NAME,
+                                    '--http_port', str(http_port), '--grpc_port', str(http_port + 1),
+                                    '--pool_workers', str(options['workers']),
+                                    '--pool_executor', options['executor'], *args])
+        try:
+            wait_until_ready(f'http://localhost:{http_port}/v1/models/{MODEL_NAME}', process)
+        except click.ClickException:
+            stop_servers([process])
+            raise
+        return process
+
+    batching = ['--max_batch_size', str(options['max_batch_size'])]
+    fingerprints = ['--n_bits', str(n_bits), '--lru_cache_size', str(options['lru_size'])]
+    processes = []
+    try:
+        if scenario == FUSED:
+            processes.append(serve('serve_combined', port, *fingerprints, *batching))
+        else:
+            processes.append(serve('serve_predictor', port + 2, *batching))
+            processes.append(serve('serve_transformer', port, *fingerprints, '--encoding', SPLIT[scenario],
+                                   '--predictor_host', f'localhost:{port + 2}'))
+    except Exception:
+        stop_servers(processes)
+        raise
+    return processes, f'http://localhost:{port}/v1/models/{MODEL_NAME}:predict'
+
+
+def stop_servers(processes: List[subprocess.Popen]) -> None:
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+@click.command()
+@click.option('--input-data', '-i', help="Path to the SMILES to replay (csv.zip).", required=True, type=str)
+@click.option('--input-model', '-m', help="Path to a trained model, by default one is trained on the input.",
+              required=False, type=str)
+@click.option('--output-report', '-o', help="Path to store the results as JSON.", required=False, type=str)
+@click.option('--mode', help="Run the models in this process or as model servers on localhost.",
+              type=click.Choice([IN_PROCESS, HTTP]), default=IN_PROCESS)
+@click.option('--scenario', '-s', help="Deployment to benchmark, can be repeated. Defaults to all.", multiple=True,
+              type=click.Choice(SCENARIOS))
+@click.option('--concurrency', '-c', help="Number of concurrent clients, can be repeated.", multiple=True, type=int,
+              default=[1, 8])
+@click.option('--batch-size', '-b', help="Number of SMILES per request, can be repeated.", multiple=True, type=int,
+              default=[1, 32])
+@click.option('--requests', '-r', help="Number of requests per run.", type=int, default=200)
+@click.option('--warmup', help="Number of unmeasured requests before each run.", type=int, default=10)
+@click.option('--fp-bits', '-n', help="Number of the fingerprint bits.", type=int, default=1024)
+@click.option('--n-trees', help="Number of trees of the model trained on the input.", type=int, default=100)
+@click.option('--flat', help="Serve the trained model flattened, see `chem-util.py export`.", is_flag=True,
+              default=False)
+@click.option('--max-batch-size', help="Micro-batching of the predictor, 0 to disable.", type=int, default=0)
+@click.option('--pool-workers', help="Pool workers of the models, 0 to run on the event loop.", type=int, default=0)
+@click.option('--pool-executor', help="Kind of pool the workers run in.", type=click.Choice(EXECUTORS),
+              default=THREAD)
+@click.option('--lru-cache-size', help="In-memory fingerprint LRU cache, 0 to disable.", type=int, default=0)
+@click.option('--port', help="First localhost port used in http mode.", type=int, default=18080)
+def benchmark(input_data, input_model, output_report, mode, scenario, concurrency, batch_size, requests, warmup,
+              fp_bits, n_trees, flat, max_batch_size, pool_workers, pool_executor, lru_cache_size, port):
+    """Replays SMILES against the serving models and reports throughput and latency percentiles."""
+    df = pd.read_csv(input_data)
+    smiles = df['Smiles'].tolist()
+    options = {'max_batch_size': max_batch_size, 'workers': pool_workers, 'executor': pool_executor,
+               'lru_size': lru_cache_size}
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        if input_model:
+            os.environ['MODEL_DIR'], os.environ['MODEL_FILENAME'] = os.path.split(os.path.abspath(input_model))
+        else:
+            filename = 'model.npz' if flat else 'model.joblib'
+            train_model(smiles, df['class'].values, fp_bits, n_trees, os.path.join(model_dir, filename), flat)
+            os.environ['MODEL_DIR'], os.environ['MODEL_FILENAME'] = model_dir, filename
+
+        results = []
+        for name in scenario or SCENARIOS:
+            logger.info(f'Benchmarking {name} ({mode}).')
+            if mode == IN_PROCESS:
+                loop = asyncio.new_event_loop()
+                call, executors = in_process_call(name, fp_bits, options)
+            else:
+                processes, url = start_servers(name, fp_bits, options, port)
+            try:
+                for c in concurrency:
+                    for b in batch_size:
+                        # consecutive requests get consecutive SMILES, wrapping around at the end of the input
+                        molecules = cycle(smiles)
+                        batches = [list(islice(molecules, b)) for _ in range(warmup + requests)]
+                        if mode == IN_PROCESS:
+                            loop.run_until_complete(replay_in_process(call, batches[:warmup], c))
+                            latencies, errors, seconds = loop.run_until_complete(
+                                replay_in_process(call, batches[warmup:], c))
+                        else:
+                            replay_http(url, batches[:warmup], c)
+                            latencies, errors, seconds = replay_http(url, batches[warmup:], c)
+                        results.append({'scenario': name, 'mode': mode, 'concurrency': c, 'batch_size': b,
+                                        **summarize(latencies, seconds, b, errors)})
+                        logger.info(f'{results[-1]}')
+            finally:
+                if mode == IN_PROCESS:
+                    # background tasks of the models, e.g. the micro-batcher, end with the loop
+                    tasks = asyncio.all_tasks(loop)
+                    for task in tasks:
+                        task.cancel()
+                    if tasks:
+                        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+                    loop.close()
+                    # process pools would otherwise keep their workers until the benchmark exits
+                    for executor in executors:
+                        if executor is not None:
+                            executor.shutdown()
+                else:
+                    stop_servers(processes)
+
+    print(pd.DataFrame(results).to_string(index=False))
+    if output_report:
+        with open(output_report, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,9 +1,18 @@
 import click
 import logging
+import os
+import numpy as np
 import pandas as pd
-from src.features import get_cfps
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from typing import Dict, List, Optional
+from src.cache import FingerprintCache
+from src.data import Features, FeatureWriter, save_features, load_features, count_rows, save_indices, load_indices
+from src.features import fold_fps, get_cfps_batch
+from src.forest import FlatForest
 from src.utils import mol2html
-from rdkit.Chem import PandasTools
+from rdkit import Chem
 from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestClassifier
 import joblib
@@ -19,39 +28,130 @@ def cli():
     pass
 
 
+def calculate_fps(smiles: List[str], fp_bits: int, jobs: int = 1, packed: bool = True,
+                  cache: Optional[FingerprintCache] = None, executor: Optional[Executor] = None) -> np.ndarray:
+    """Calculates fingerprints for SMILES, in chunks on a process pool if jobs > 1. Row order is kept.
+
+    The pool is created for this call, unless one is passed as executor to share it across calls.
+    """
+    if jobs <= 0:
+        jobs = os.cpu_count()
+    fps = partial(get_cfps_batch, nBits=fp_bits, packed=packed)
+    if jobs == 1 or len(smiles) < 2:
+        return cache.get_cfps_batch(smiles, nBits=fp_bits, packed=packed) if cache is not None else fps(smiles)
+
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return calculate_fps(smiles, fp_bits, jobs, packed, cache, executor)
+
+    def map_chunks(fn, items):
+        chunk_size = max(1, -(-len(items) // (jobs * 4)))  # a few chunks per worker to balance the load
+        return list(executor.map(fn, [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]))
+
+    if cache is None:
+        return np.concatenate(map_chunks(fps, smiles))
+    # SMILES are parsed and canonicalized in the workers, only the lookups run in this process
+    keys = [key for chunk in map_chunks(partial(FingerprintCache.canonical_keys, nBits=fp_bits), smiles)
+            for key in chunk]
+    return cache.get_cfps_batch(smiles, nBits=fp_bits, packed=packed, keys=keys, calculate=lambda misses: (
+        np.concatenate(map_chunks(partial(get_cfps_batch, nBits=fp_bits, packed=True), misses))))
+
+
+def write_samples(path: str, samples: Dict) -> None:
+    """Writes a markdown file with one sample molecule (SMILES) per class."""
+    md_data = """# Sample molecules\n"""
+    for c, smiles in samples.items():
+        md_data += f"## Class {c}\n"
+        md_data += mol2html(Chem.MolFromSmiles(smiles), legend=f'Class: {c}')
+        md_data += "\n"
+    with open(path, 'w') as f:
+        f.write(md_data)
+
+
 @cli.command('preprocess')
 @click.option('--input-data', '-i', help="Path to the input data (csv.zip).", required=True, type=str)
-@click.option('--output-data', '-o', help="Path to the output.", required=True, type=str)
+@click.option('--output-data', '-o', help="Path to the output (npz with bit-packed fingerprints).", required=True,
+              type=str)
+@click.option('--output-csv', '-c', help="Optional path to also export the features as csv.zip.", required=False,
+              type=str)
 @click.option('--fp-bits', '-n', help="Number of the fingerprint bits.", required=False, type=int,
               default=1024)
 @click.option('--id_col', '-d', help="Name of the ID col.", required=False, type=str, default='ID')
 @click.option('--target', '-t', help="Name of the target col.", required=False, type=str, default='class')
 @click.option('--sample', '-s', help="Path to where to store class samples.", required=False, type=str)
-def preprocess(input_data, output_data, fp_bits, id_col, target, sample):
+@click.option('--jobs', '-j', help="Number of worker processes for featurization, 0 to use all cores.",
+              required=False, type=int, default=1)
+@click.option('--chunk-size', '-k', help="Stream the input in chunks of this many rows to bound memory.",
+              required=False, type=int)
+@click.option('--cache', help="Path to a fingerprint cache (SQLite), reused across runs.", required=False, type=str)
+@click.option('--cache-size', help="Maximum number of fingerprints kept in the cache.", required=False, type=int,
+              default=1_000_000)
+@click.option('--fold', '-f', help="Also store the features folded to BITS at PATH, can be repeated.",
+              type=(int, str), multiple=True, metavar='BITS PATH')
+def preprocess(input_data, output_data, output_csv, fp_bits, id_col, target, sample, jobs, chunk_size, cache,
+               cache_size, fold):
+    for bits, _ in fold:
+        if bits <= 0 or fp_bits % bits:
+            raise click.UsageError(f"--fold {bits} must divide --fp-bits {fp_bits}.")
+    fp_cache = FingerprintCache(cache, max_entries=cache_size) if cache else None
+    if chunk_size:
+        if output_csv:
+            raise click.UsageError("--output-csv is not supported together with --chunk-size.")
+        logger.info(f"Streaming {input_data} in chunks of {chunk_size} rows.")
+        samples = {}
+        with ExitStack() as stack:
+            writer = stack.enter_context(FeatureWriter(output_data, fp_bits, id_col=id_col, target_col=target))
+            # one pool for all chunks, so that workers start and import RDKit only once
+            executor = stack.enter_context(ProcessPoolExecutor(jobs if jobs > 0 else None)) if jobs != 1 else None
+            folded = {bits: stack.enter_context(FeatureWriter(path, bits, id_col=id_col, target_col=target))
+                      for bits, path in fold}
+            for df in pd.read_csv(input_data, index_col=0, compression='zip', chunksize=chunk_size):
+                fps = calculate_fps(df['Smiles'].tolist(), fp_bits, jobs, cache=fp_cache, executor=executor)
+                writer.append(fps, df[id_col].values, df[target].values)
+                for bits, folded_writer in folded.items():
+                    folded_writer.append(fold_fps(fps, fp_bits, bits, packed=True), df[id_col].values,
+                                         df[target].values)
+                for c, smiles in df.drop_duplicates(target)[[target, 'Smiles']].values:
+                    samples.setdefault(c, smiles)
+                logger.info(f"Calculated features for {writer.n_rows} rows.")
+            logger.info(f"Storing to {output_data}.")
+        if fp_cache is not None:
+            logger.info(f"Fingerprint cache: {fp_cache.stats()}.")
+        if sample:
+            write_samples(sample, samples)
+        return
     logger.info(f"Reading in {input_data}.")
     df = pd.read_csv(input_data, index_col=0, compression='zip')
     logger.info("Calculating features.")
-    PandasTools.AddMoleculeColumnToFrame(df, smilesCol='Smiles')  # adding mol objects
-    fp_cols = [f'bit_{x}' for x in range(fp_bits)]
-    df = df.join(
-        pd.DataFrame(
-            data=[get_cfps(row[1]['ROMol'], nBits=fp_bits) for row in df.iterrows()],
-            columns=fp_cols
-        )
-    )
+    features = Features(fps=calculate_fps(df['Smiles'].tolist(), fp_bits, jobs, cache=fp_cache),
+                        ids=df[id_col].values, target=df[target].values, n_bits=fp_bits, id_col=id_col,
+                        target_col=target)
+    if fp_cache is not None:
+        logger.info(f"Fingerprint cache: {fp_cache.stats()}.")
     logger.info(f"Storing to {output_data}.")
-    df[[id_col, target] + fp_cols].to_csv(output_data, compression='zip')
+    save_features(output_data, features)
+    for bits, path in fold:
+        logger.info(f"Storing features folded to {bits} bits to {path}.")
+        save_features(path, features.fold(bits))
+    if output_csv:
+        logger.info(f"Exporting to {output_csv}.")
+        features.to_frame().to_csv(output_csv, compression='zip')
     if sample:
-        md_data = """# Sample molecules\n"""
+        write_samples(sample, dict(df.drop_duplicates(target)[[target, 'Smiles']].values))
 
-        classes = df[target].unique()
-        for c in classes:
-            md_data += f"## Class {c}\n"
-            m = df[df[target] == c].iloc[0]['ROMol']
-            md_data += mol2html(m, legend=f'Class: {c}')
-            md_data += "\n"
-        with open(sample, 'w') as f:
-            f.write(md_data)
+
+@cli.command('fold')
+@click.option('--input-data', '-i', help="Path to the features (npz).", required=True, type=str)
+@click.option('--output-data', '-o', help="Path to the folded features (npz).", required=True, type=str)
+@click.option('--fp-bits', '-n', help="Number of bits to fold the fingerprints to, must divide their width.",
+              required=True, type=int)
+def fold(input_data, output_data, fp_bits):
+    logger.info(f"Reading in {input_data}.")
+    features = load_features(input_data)
+    if fp_bits <= 0 or features.n_bits % fp_bits:
+        raise click.UsageError(f"--fp-bits {fp_bits} must divide the {features.n_bits} bits of {input_data}.")
+    logger.info(f"Folding {features.n_bits} to {fp_bits} bits and storing to {output_data}.")
+    save_features(output_data, features.fold(fp_bits))
 
 
 @cli.command('split')
@@ -60,54 +160,80 @@ def preprocess(input_data, output_data, fp_bits, id_col, target, sample):
 @click.option('--output-test', '-t', help="Path to the test output.", required=True, type=str)
 @click.option('--test-fraction', '-f', help="Fraction of dataset to used for evaluation.",
               required=False, type=float, default=0.2)
-@click.option('--seed', '-f', help="Random seed.",
+@click.option('--seed', '-s', help="Random seed.",
               required=False, type=int, default=42)
-def split(input_data, output_train, output_test, test_fraction, seed):
+@click.option('--indices-only', help="Only store train and test row indices instead of copies of the data.",
+              is_flag=True, default=False)
+def split(input_data, output_train, output_test, test_fraction, seed, indices_only):
     if not(0.0 < test_fraction < 1.0):
         raise ValueError(f"test_fraction should be between 0 and 1. Provided was {test_fraction}")
-    logger.info(f"Reading in {input_data}.")
-    df = pd.read_csv(input_data, index_col=0, compression='zip')
+    if indices_only:
+        n_rows = count_rows(input_data)
+    else:
+        logger.info(f"Reading in {input_data}.")
+        features = load_features(input_data)
+        n_rows = len(features.ids)
     logger.info("Splitting.")
-    train, test = train_test_split(list(range(len(df))), random_state=seed, test_size=test_fraction)
-    logger.info(f"Storing to {output_train}.")
-    df.iloc[train].to_csv(output_train, compression='zip')
-    logger.info(f"Storing to {output_test}.")
-    df.iloc[test].to_csv(output_test, compression='zip')
+    train, test = train_test_split(list(range(n_rows)), random_state=seed, test_size=test_fraction)
+    logger.info(f"Storing to {output_train} and {output_test}.")
+    if indices_only:
+        save_indices(output_train, train)
+        save_indices(output_test, test)
+    else:
+        save_features(output_train, features.take(train))
+        save_features(output_test, features.take(test))
 
 
 @cli.command('train')
 @click.option('--input-data', '-i', help="Path to the training data.", required=True, type=str)
+@click.option('--indices', '-x', help="Path to train row indices from `split --indices-only`.", required=False,
+              type=str)
 @click.option('--output-model', '-o', help="Path to the output model.", required=True, type=str)
-@click.option('--target', '-t', help="Name of the target col.", required=False, type=str, default='class')
 @click.option('--n-trees', '-n', help="Number of trees.", required=False, type=int, default=16)
-def train(input_data, output_model, target, n_trees):
+@click.option('--n-jobs', '-j', help="Number of trees fitted in parallel, -1 to use all cores.", required=False,
+              type=int, default=1)
+@click.option('--sparse/--dense', help="Fit on a sparse CSR matrix (default) or on a dense array.", default=True)
+def train(input_data, indices, output_model, n_trees, n_jobs, sparse):
     logger.info(f"Reading in {input_data}.")
-    df = pd.read_csv(input_data, index_col=0, compression='zip')
-    fp_cols = [x for x in df.columns if 'bit_' in x]
-    logger.info(f'Detected {len(fp_cols)} fingerprint columns.')
-    logger.info(f'Fitting a RandomForestClassifier model with {n_trees} trees.')
-    clf = RandomForestClassifier(n_estimators=n_trees)
-    clf.fit(df[fp_cols], df[target])
+    features = load_features(input_data, rows=load_indices(indices) if indices else None)
+    logger.info(f'Detected {features.n_bits} fingerprint bits.')
+    logger.info(f'Fitting a RandomForestClassifier model with {n_trees} trees on {n_jobs} jobs.')
+    clf = RandomForestClassifier(n_estimators=n_trees, n_jobs=n_jobs)
+    clf.fit(features.sparse() if sparse else features.dense(), features.target)
+    # the pickled n_jobs would otherwise fan every served predict call out to a joblib pool
+    clf.set_params(n_jobs=None)
     logger.info(f'Saving model {output_model}')
     joblib.dump(clf, output_model)
 
 
 @cli.command('evaluate')
 @click.option('--input-data', '-i', help="Path to the test data.", required=True, type=str)
+@click.option('--indices', '-x', help="Path to test row indices from `split --indices-only`.", required=False,
+              type=str)
 @click.option('--input-model', '-m', help="Path to the model.", required=True, type=str)
 @click.option('--output-metrics', '-o', help="Filename where to store metrics.", required=False, type=str)
-def evaluate(input_data, input_model, output_metrics):
+def evaluate(input_data, indices, input_model, output_metrics):
     logger.info(f"Reading in {input_data}.")
-    df = pd.read_csv(input_data, index_col=0, compression='zip')
+    features = load_features(input_data, rows=load_indices(indices) if indices else None)
     logger.info(f"Reading in the model {input_model}.")
     clf = joblib.load(input_model)
-    fp_cols = [x for x in df.columns if 'bit_' in x]
-    score = roc_auc_score(df['class'].values, clf.predict_proba(df[fp_cols])[:, 1])
+    score = roc_auc_score(features.target, clf.predict_proba(features.sparse())[:, 1])
     logger.info(f'Model roc auc score is: {score}.')
     if output_metrics:
         with open(output_metrics, 'w') as f:
             f.write(str(score))
 
 
+@cli.command('export')
+@click.option('--input-model', '-m', help="Path to the model.", required=True, type=str)
+@click.option('--output-model', '-o', help="Path to the flattened model (npz).", required=True, type=str)
+def export(input_model, output_model):
+    logger.info(f"Reading in the model {input_model}.")
+    clf = joblib.load(input_model)
+    forest = FlatForest.from_sklearn(clf)
+    logger.info(f"Saving {forest} to {output_model}.")
+    forest.save(output_model)
+
+
 if __name__ == '__main__':
     cli()
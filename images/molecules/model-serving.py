@@ -1,6 +1,8 @@
 import kserve
 import click
-from src.serving import MolTransformer, MolPredictor
+from src.encoding import DENSE, ENCODINGS
+from src.executors import EXECUTORS, THREAD
+from src.serving import MolTransformer, MolPredictor, MolClassifier
 
 DEFAULT_MODEL_NAME = "model"
 
@@ -19,11 +21,29 @@ def cli():
 @click.option('--predictor_host', help='The URL for the model predict function', required=True, type=str)
 @click.option('--n_bits', help='Number of bits to use for the fingerprint', required=False, type=int,
               default=1024)
-def serve_transformer(model_name, predictor_host, n_bits):
+@click.option('--fp_cache', help='Path to a persistent fingerprint cache (SQLite)', required=False, type=str)
+@click.option('--fp_cache_size', help='Maximum number of fingerprints kept in the cache', required=False, type=int,
+              default=1_000_000)
+@click.option('--lru_cache_size', help='Number of fingerprints kept in an in-memory LRU cache, 0 to disable',
+              required=False, type=int, default=0)
+@click.option('--encoding', help='Encoding of the fingerprints sent to the predictor', required=False,
+              type=click.Choice(ENCODINGS), default=DENSE)
+@click.option('--pool_workers', help='Number of pool workers for CPU-bound work, 0 to run it on the event loop',
+              required=False, type=int, default=0)
+@click.option('--pool_executor', help='Kind of pool the workers run in', required=False, type=click.Choice(EXECUTORS),
+              default=THREAD)
+def serve_transformer(model_name, predictor_host, n_bits, fp_cache, fp_cache_size, lru_cache_size, encoding,
+                      pool_workers, pool_executor):
     transformer = MolTransformer(
         name=model_name,
         predictor_host=predictor_host,
-        n_bits=n_bits
+        n_bits=n_bits,
+        cache_path=fp_cache,
+        cache_size=fp_cache_size,
+        lru_size=lru_cache_size,
+        encoding=encoding,
+        workers=pool_workers,
+        executor=pool_executor
     )
     server = kserve.ModelServer()
     server.start(models=[transformer])
@@ -35,13 +55,76 @@ def serve_transformer(model_name, predictor_host, n_bits):
 ))
 @click.option('--model_name', default=DEFAULT_MODEL_NAME,
               help='The name that the model is served under.', type=str)
-def serve_predictor(model_name):
+@click.option('--max_batch_size', help='Batch concurrent requests up to this many rows, 0 to disable',
+              required=False, type=int, default=0)
+@click.option('--max_batch_wait_ms', help='Maximum time a request waits for others to join its batch',
+              required=False, type=float, default=5.0)
+@click.option('--pool_workers', help='Number of pool workers for CPU-bound work, 0 to run it on the event loop',
+              required=False, type=int, default=0)
+@click.option('--pool_executor', help='Kind of pool the workers run in', required=False, type=click.Choice(EXECUTORS),
+              default=THREAD)
+@click.option('--mmap_model', help='Memory-map the node arrays of an exported FlatForest instead of copying them',
+              is_flag=True, default=False)
+@click.option('--warmup_rows', help='Predict on this many synthetic fingerprints before reporting ready',
+              required=False, type=int, default=0)
+def serve_predictor(model_name, max_batch_size, max_batch_wait_ms, pool_workers, pool_executor, mmap_model,
+                    warmup_rows):
     predictor = MolPredictor(
         name=model_name,
+        max_batch_size=max_batch_size,
+        max_batch_wait_ms=max_batch_wait_ms,
+        workers=pool_workers,
+        executor=pool_executor,
+        mmap=mmap_model,
+        warmup_rows=warmup_rows
     )
     server = kserve.ModelServer()
     server.start(models=[predictor])
 
 
+@cli.command('serve_combined', context_settings=dict(
+    ignore_unknown_options=True,
+    allow_extra_args=True,
+))
+@click.option('--model_name', default=DEFAULT_MODEL_NAME,
+              help='The name that the model is served under.', type=str)
+@click.option('--n_bits', help='Number of bits to use for the fingerprint', required=False, type=int,
+              default=1024)
+@click.option('--fp_cache', help='Path to a persistent fingerprint cache (SQLite)', required=False, type=str)
+@click.option('--fp_cache_size', help='Maximum number of fingerprints kept in the cache', required=False, type=int,
+              default=1_000_000)
+@click.option('--lru_cache_size', help='Number of fingerprints kept in an in-memory LRU cache, 0 to disable',
+              required=False, type=int, default=0)
+@click.option('--max_batch_size', help='Batch concurrent requests up to this many rows, 0 to disable',
+              required=False, type=int, default=0)
+@click.option('--max_batch_wait_ms', help='Maximum time a request waits for others to join its batch',
+              required=False, type=float, default=5.0)
+@click.option('--pool_workers', help='Number of pool workers for CPU-bound work, 0 to run it on the event loop',
+              required=False, type=int, default=0)
+@click.option('--pool_executor', help='Kind of pool the workers run in', required=False, type=click.Choice(EXECUTORS),
+              default=THREAD)
+@click.option('--mmap_model', help='Memory-map the node arrays of an exported FlatForest instead of copying them',
+              is_flag=True, default=False)
+@click.option('--warmup_rows', help='Predict on this many synthetic fingerprints before reporting ready',
+              required=False, type=int, default=0)
+def serve_combined(model_name, n_bits, fp_cache, fp_cache_size, lru_cache_size, max_batch_size,
+                   max_batch_wait_ms, pool_workers, pool_executor, mmap_model, warmup_rows):
+    classifier = MolClassifier(
+        name=model_name,
+        n_bits=n_bits,
+        cache_path=fp_cache,
+        cache_size=fp_cache_size,
+        lru_size=lru_cache_size,
+        max_batch_size=max_batch_size,
+        max_batch_wait_ms=max_batch_wait_ms,
+        workers=pool_workers,
+        executor=pool_executor,
+        mmap=mmap_model,
+        warmup_rows=warmup_rows
+    )
+    server = kserve.ModelServer()
+    server.start(models=[classifier])
+
+
 if __name__ == "__main__":
     cli()
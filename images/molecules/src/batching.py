@@ -0,0 +1,101 @@
+from concurrent.futures import Executor
+from typing import Callable, List, Optional, Tuple
+import asyncio
+import time
+import numpy as np
+from .executors import run_blocking
+
+
+class MicroBatcher:
+    """Merges concurrent requests into one call of a batch function.
+
+    Requests wait for at most `max_wait_ms` for others to join them. A batch is run as soon as it holds
+    `max_batch_size` rows or the wait window of its first request has passed, and every caller gets back its own
+    slice of the results.
+
+    Parameters
+    ----------
+    predict_fn : Callable[[np.ndarray], np.ndarray]
+        Function applied to the concatenated rows of a batch, returning one result per row
+    max_batch_size : int
+        Number of rows after which a batch is run without waiting any longer
+    max_wait_ms : float
+        Maximum time in milliseconds a request waits for others to join its batch
+    executor : Executor, optional
+        Pool that predict_fn is run on, inline on the event loop if None
+    observe : Callable[[int, float], None], optional
+        Called with the number of rows and the duration in seconds of every batch that was run
+    """
+
+    def __init__(self, predict_fn: Callable[[np.ndarray], np.ndarray], max_batch_size: int = 64,
+                 max_wait_ms: float = 5.0, executor: Optional[Executor] = None,
+                 observe: Optional[Callable[[int, float], None]] = None):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self.observe = observe
+        self._queue: Optional[asyncio.Queue] = None
+        self._added: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._running = set()
+
+    async def submit(self, instances: np.ndarray) -> np.ndarray:
+        """Queues rows for the next batch and returns their results once it has run."""
+        if self._task is None or self._task.done():
+            # created lazily so that queue and task belong to the loop of the model server
+            self._queue = asyncio.Queue()
+            self._added = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((instances, future))
+        self._added.set()
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            n_rows = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while n_rows < self.max_batch_size:
+                if not self._queue.empty():
+                    item = self._queue.get_nowait()
+                    batch.append(item)
+                    n_rows += len(item[0])
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                # waiting on an event rather than on the queue, so a timeout can never drop a request
+                self._added.clear()
+                try:
+                    await asyncio.wait_for(self._added.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            # batches run as tasks, so the next one is collected while a pool works on this one
+            task = loop.create_task(self._predict(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _predict(self, batch: List[Tuple[np.ndarray, asyncio.Future]]) -> None:
+        start = time.perf_counter()
+        try:
+            # rows of different widths or dtypes fail to concatenate, and then fall back to one call per request
+            instances = np.concatenate([instances for instances, _ in batch])
+            results = await run_blocking(self.executor, self.predict_fn, instances)
+        except Exception as e:
+            if len(batch) > 1:
+                # one malformed request must not fail the others it was batched with
+                for item in batch:
+                    await self._predict([item])
+                return
+            if not batch[0][1].done():
+                batch[0][1].set_exception(e)
+            return
+        if self.observe is not None:
+            self.observe(len(instances), time.perf_counter() - start)
+        offsets = np.cumsum([len(instances) for instances, _ in batch])[:-1]
+        for (_, future), result in zip(batch, np.split(results, offsets)):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,214 @@
+from collections import OrderedDict
+from functools import partial
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Union
+from rdkit import Chem
+from rdkit.Chem.rdchem import Mol
+import numpy as np
+import sqlite3
+import threading
+from .features import get_cfps_batch
+
+
+class LRUCache:
+    """Bounded in-memory cache that evicts the least recently used entry when full.
+
+    Parameters
+    ----------
+    capacity : int
+        Maximum number of entries
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns hit, miss and eviction counters and the current number of entries."""
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._data)}
+
+
+class FingerprintCache:
+    """Persistent fingerprint cache in a local SQLite file.
+
+    Entries are bit-packed fingerprints keyed by canonical SMILES and fingerprint parameters. When the cache
+    grows beyond `max_entries`, the least recently used entries are evicted. Lookups only read: the times entries
+    were last used are kept in memory and written with the next insert, every `_FLUSH` lookups, or on `close`.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database file, created if it does not exist
+    max_entries : int
+        Maximum number of fingerprints kept in the cache
+    """
+
+    _BATCH = 500  # stays below SQLite's limit of host parameters per statement
+    _FLUSH = 1000  # lookups after which the last used times are written even without inserts
+
+    def __init__(self, path: str, max_entries: int = 1_000_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # readers do not block on the writer, and commits are not fsynced one by one
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS fps (key TEXT PRIMARY KEY, fp BLOB, last_used INTEGER)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS fps_last_used ON fps (last_used)')
+        self._conn.commit()
+        self._clock, self._size = self._conn.execute(
+            'SELECT COALESCE(MAX(last_used), 0), COUNT(*) FROM fps').fetchone()
+        self._touched = {}
+        self._lookups = 0
+        with self._lock:
+            # a cache reopened with a smaller max_entries shrinks right away
+            self._evict()
+            self._conn.commit()
+
+    @staticmethod
+    def key(smiles: str, radius: int, nBits: int, useFeatures: bool) -> str:
+        """Cache key of a canonical SMILES for the given fingerprint parameters."""
+        return f'{radius}:{nBits}:{int(useFeatures)}:{smiles}'
+
+    @staticmethod
+    def canonical_keys(smiles: Sequence[str], radius: int = 1, nBits: int = 1024,
+                       useFeatures: bool = False) -> List[str]:
+        """Parses and canonicalizes SMILES into cache keys, e.g. in pool workers ahead of `get_cfps_batch`."""
+        keys = []
+        for i, s in enumerate(smiles):
+            mol = Chem.MolFromSmiles(s)
+            if mol is None:
+                raise ValueError(f"Invalid molecule at position {i}.")
+            keys.append(FingerprintCache.key(Chem.MolToSmiles(mol), radius, nBits, useFeatures))
+        return keys
+
+    def get_cfps_batch(self, smiles: Sequence[str], radius: int = 1, nBits: int = 1024, useFeatures: bool = False,
+                       packed: bool = False, dtype: np.dtype = np.int8,
+                       keys: Optional[Sequence[str]] = None,
+                       calculate: Optional[Callable[[List[Union[Mol, str]]], np.ndarray]] = None) -> np.ndarray:
+        """Same as `features.get_cfps_batch` for SMILES, but only calculates fingerprints missing in the cache.
+
+        Parameters
+        ----------
+        smiles : Sequence[str]
+            Molecules as SMILES strings
+        radius, nBits, useFeatures, packed, dtype
+            See `features.get_cfps_batch`
+        keys : Sequence[str], optional
+            Keys of the SMILES from `canonical_keys`, calculated here if not given
+        calculate : Callable[[List[Mol | str]], np.ndarray], optional
+            Calculates bit-packed fingerprints of the cache misses, with the parameters above. It is given the
+            parsed molecules, or the SMILES if keys were passed. Defaults to `features.get_cfps_batch`.
+
+        Returns
+        -------
+        np.ndarray
+            2D array of shape (len(smiles), nBits), or (len(smiles), ceil(nBits / 8)) of uint8 if packed
+        """
+        if keys is None:
+            mols = [Chem.MolFromSmiles(s) for s in smiles]
+            for i, mol in enumerate(mols):
+                if mol is None:
+                    raise ValueError(f"Invalid molecule at position {i}.")
+            keys = [self.key(Chem.MolToSmiles(mol), radius, nBits, useFeatures) for mol in mols]
+        else:
+            mols = smiles
+        found = self._get(keys)
+        missing = [i for i, k in enumerate(keys) if k not in found]
+
+        out = np.zeros((len(keys), (nBits + 7) // 8), np.uint8)
+        for i, k in enumerate(keys):
+            if k in found:
+                out[i] = np.frombuffer(found[k], np.uint8)
+        if missing:
+            if calculate is None:
+                calculate = partial(get_cfps_batch, radius=radius, nBits=nBits, useFeatures=useFeatures, packed=True)
+            out[missing] = calculate([mols[i] for i in missing])
+            self._put({keys[i]: out[i].tobytes() for i in missing})
+        if packed:
+            return out
+        return np.unpackbits(out, axis=1, count=nBits).astype(dtype, copy=False)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns hit, miss and eviction counters and the current number of entries."""
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': self._size}
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush()
+            self._conn.commit()
+        self._conn.close()
+
+    def _get(self, keys: List[str]) -> Dict[str, bytes]:
+        unique = list(set(keys))
+        found = {}
+        with self._lock:
+            self._clock += 1
+            for i in range(0, len(unique), self._BATCH):
+                batch = unique[i:i + self._BATCH]
+                params = ','.join('?' * len(batch))
+                found.update(self._conn.execute(f'SELECT key, fp FROM fps WHERE key IN ({params})', batch))
+            self._touched.update(dict.fromkeys(found, self._clock))
+            hits = sum(k in found for k in keys)
+            self.hits += hits
+            self.misses += len(keys) - hits
+            self._lookups += 1
+            if self._lookups >= self._FLUSH:
+                self._flush()
+                self._conn.commit()
+        return found
+
+    def _put(self, entries: Dict[str, bytes]) -> None:
+        with self._lock:
+            # concurrent misses of the same key both land here, only rows actually inserted are counted
+            changes = self._conn.total_changes
+            self._conn.executemany('INSERT OR IGNORE INTO fps (key, fp, last_used) VALUES (?, ?, ?)',
+                                   [(k, v, self._clock) for k, v in entries.items()])
+            self._size += self._conn.total_changes - changes
+            self._flush()
+            self._evict()
+            self._conn.commit()
+
+    def _flush(self) -> None:
+        """Writes the last used times of the lookups since the previous flush, with the lock held."""
+        if self._touched:
+            self._conn.executemany('UPDATE fps SET last_used = ? WHERE key = ?',
+                                   [(clock, k) for k, clock in self._touched.items()])
+            self._touched = {}
+        self._lookups = 0
+
+    def _evict(self) -> None:
+        """Deletes the least recently used entries beyond max_entries, with the lock held."""
+        excess = self._size - self.max_entries
+        if excess > 0:
+            deleted = self._conn.execute(
+                'DELETE FROM fps WHERE key IN (SELECT key FROM fps ORDER BY last_used LIMIT ?)', (excess,)).rowcount
+            self._size -= deleted
+            self.evictions += deleted
@@ -0,0 +1,187 @@
+from typing import NamedTuple
+import os
+import shutil
+import tempfile
+import zipfile
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from .features import fold_fps
+
+
+class Features(NamedTuple):
+    """Featurized dataset: bit-packed fingerprints with IDs and targets."""
+    fps: np.ndarray
+    ids: np.ndarray
+    target: np.ndarray
+    n_bits: int
+    id_col: str = 'ID'
+    target_col: str = 'class'
+
+    def take(self, rows: np.ndarray) -> 'Features':
+        """Returns the features of the selected rows."""
+        return self._replace(fps=self.fps[rows], ids=self.ids[rows], target=self.target[rows])
+
+    def fold(self, n_bits: int) -> 'Features':
+        """Returns the features with fingerprints folded to n_bits, see `features.fold_fps`."""
+        return self._replace(fps=fold_fps(self.fps, self.n_bits, n_bits, packed=True), n_bits=n_bits)
+
+    def dense(self, dtype: np.dtype = np.int8) -> np.ndarray:
+        """Unpacks fingerprints into a (n_rows, n_bits) array."""
+        return np.unpackbits(self.fps, axis=1, count=self.n_bits).astype(dtype, copy=False)
+
+    def sparse(self, chunk_size: int = 10000) -> csr_matrix:
+        """Unpacks fingerprints into a (n_rows, n_bits) CSR matrix, chunk by chunk to avoid a full dense copy."""
+        indices, indptr = [], [np.zeros(1, np.int64)]
+        for start in range(0, len(self.fps), chunk_size):
+            rows, cols = np.nonzero(np.unpackbits(self.fps[start:start + chunk_size], axis=1, count=self.n_bits))
+            indices.append(cols.astype(np.int32))
+            indptr.append(indptr[-1][-1] + np.cumsum(
+                np.bincount(rows, minlength=min(chunk_size, len(self.fps) - start))))
+        indices = np.concatenate(indices) if indices else np.zeros(0, np.int32)
+        return csr_matrix((np.ones(len(indices), np.float32), indices, np.concatenate(indptr)),
+                          shape=(len(self.fps), self.n_bits))
+
+    def to_frame(self) -> pd.DataFrame:
+        """Returns the features in the wide `bit_0..bit_N` layout."""
+        df = pd.DataFrame(self.dense(), columns=[f'bit_{x}' for x in range(self.n_bits)])
+        df.insert(0, self.target_col, self.target)
+        df.insert(0, self.id_col, self.ids)
+        return df
+
+
+def save_features(path: str, features: Features) -> None:
+    """Stores features as a compressed npz file.
+
+    Parameters
+    ----------
+    path : str
+        Output path. Written as is, no `.npz` suffix is appended.
+    features : Features
+        Features to store, fingerprints packed with np.packbits along the rows
+    """
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, fps=features.fps, ids=features.ids.astype(str), target=features.target,
+                            n_bits=features.n_bits, columns=np.array([features.id_col, features.target_col]))
+
+
+def load_features(path: str, rows: np.ndarray = None) -> Features:
+    """Reads features stored by `save_features`.
+
+    Parameters
+    ----------
+    path : str
+        Path to the npz file
+    rows : np.ndarray, optional
+        Row indices to select, e.g. as written by `chem-util.py split --indices-only`
+
+    Returns
+    -------
+    Features
+        Bit-packed fingerprints with IDs and targets
+    """
+    with np.load(path) as data:
+        id_col, target_col = data['columns'].tolist()
+        features = Features(fps=data['fps'], ids=data['ids'], target=data['target'], n_bits=int(data['n_bits']),
+                            id_col=id_col, target_col=target_col)
+    return features if rows is None else features.take(rows)
+
+
+def count_rows(path: str) -> int:
+    """Returns the number of rows in a features file without reading the fingerprints."""
+    with np.load(path) as data:
+        return len(data['target'])
+
+
+def save_indices(path: str, rows: np.ndarray) -> None:
+    """Stores row indices as a npy file, written as is without appending a suffix."""
+    with open(path, 'wb') as f:
+        np.save(f, np.asarray(rows, dtype=np.int64))
+
+
+def load_indices(path: str) -> np.ndarray:
+    """Reads row indices stored by `save_indices`."""
+    return np.load(path)
+
+
+class FeatureWriter:
+    """Writes features chunk by chunk into the same npz layout as `save_features`.
+
+    Chunks are spooled to temporary files next to the output and streamed into the npz on `close`, so memory
+    stays bounded by the chunk size and not by the number of rows.
+    """
+
+    def __init__(self, path: str, n_bits: int, id_col: str = 'ID', target_col: str = 'class'):
+        self.path = path
+        self.n_bits = n_bits
+        self.id_col = id_col
+        self.target_col = target_col
+        self.n_rows = 0
+        self._id_len = 1
+        self._target_dtype = None
+        self._tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+        self._fps = open(os.path.join(self._tmp_dir, 'fps'), 'wb')
+        self._ids = open(os.path.join(self._tmp_dir, 'ids'), 'w', encoding='utf-8')
+        self._target = open(os.path.join(self._tmp_dir, 'target'), 'wb')
+
+    def append(self, fps: np.ndarray, ids: np.ndarray, target: np.ndarray) -> None:
+        """Appends a chunk of bit-packed fingerprints with their IDs and targets."""
+        if self._target_dtype is None:
+            self._target_dtype = np.asarray(target).dtype
+        ids = [str(x) for x in ids]
+        self._id_len = max([self._id_len] + [len(x) for x in ids])
+        self._fps.write(np.ascontiguousarray(fps, dtype=np.uint8).tobytes())
+        self._ids.writelines(f'{x}\n' for x in ids)
+        self._target.write(np.asarray(target, dtype=self._target_dtype).tobytes())
+        self.n_rows += len(ids)
+
+    def close(self) -> None:
+        """Writes the npz file and removes the temporary files."""
+        try:
+            for f in (self._fps, self._ids, self._target):
+                f.close()
+            target_dtype = self._target_dtype or np.dtype(np.int64)
+            with zipfile.ZipFile(self.path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+                with open(self._fps.name, 'rb') as src:
+                    self._write_member(zf, 'fps', np.dtype(np.uint8), (self.n_rows, (self.n_bits + 7) // 8),
+                                       lambda dst: shutil.copyfileobj(src, dst))
+                with open(self._ids.name, encoding='utf-8') as src:
+                    self._write_member(zf, 'ids', np.dtype(f'<U{self._id_len}'), (self.n_rows,),
+                                       lambda dst: self._copy_ids(src, dst))
+                with open(self._target.name, 'rb') as src:
+                    self._write_member(zf, 'target', target_dtype, (self.n_rows,),
+                                       lambda dst: shutil.copyfileobj(src, dst))
+                for name, value in (('n_bits', np.array(self.n_bits)),
+                                    ('columns', np.array([self.id_col, self.target_col]))):
+                    with zf.open(f'{name}.npy', 'w') as dst:
+                        np.lib.format.write_array(dst, value)
+        finally:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def _copy_ids(self, src, dst, chunk_size: int = 65536) -> None:
+        lines = []
+        for line in src:
+            lines.append(line[:-1])
+            if len(lines) == chunk_size:
+                dst.write(np.array(lines, dtype=f'<U{self._id_len}').tobytes())
+                lines = []
+        if lines:
+            dst.write(np.array(lines, dtype=f'<U{self._id_len}').tobytes())
+
+    @staticmethod
+    def _write_member(zf: zipfile.ZipFile, name: str, dtype: np.dtype, shape: tuple, write_data) -> None:
+        with zf.open(f'{name}.npy', 'w', force_zip64=True) as dst:
+            np.lib.format.write_array_header_1_0(
+                dst, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape})
+            write_data(dst)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            for f in (self._fps, self._ids, self._target):
+                f.close()
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
@@ -0,0 +1,81 @@
+from base64 import b64decode, b64encode
+from typing import List
+import numpy as np
+
+DENSE = 'dense'
+INDICES = 'indices'
+PACKED = 'packed'
+ENCODINGS = (DENSE, INDICES, PACKED)
+
+
+def encode_fps(fps: np.ndarray, encoding: str = DENSE) -> List:
+    """Encodes a batch of fingerprints into JSON serializable instances.
+
+    Parameters
+    ----------
+    fps : np.ndarray
+        Dense (n_molecules, n_bits) array of 0/1 values
+    encoding : str
+        `dense` for lists of all bits, `indices` for lists of the indices of set bits or `packed` for base64
+        encoded bit-packed rows (see np.packbits)
+
+    Returns
+    -------
+    List
+        One encoded instance per fingerprint
+    """
+    if encoding == DENSE:
+        return fps.tolist()
+    if encoding == INDICES:
+        if not len(fps):
+            return []
+        rows, cols = np.nonzero(fps)
+        return [x.tolist() for x in np.split(cols, np.cumsum(np.bincount(rows, minlength=len(fps)))[:-1])]
+    if encoding == PACKED:
+        return [b64encode(row.tobytes()).decode('ascii') for row in np.packbits(fps, axis=1)]
+    raise ValueError(f"Unknown encoding {encoding}, expected one of {ENCODINGS}.")
+
+
+def decode_fps(instances: List, encoding: str = DENSE, n_bits: int = None, keep_packed: bool = False) -> np.ndarray:
+    """Decodes instances created by `encode_fps` into a dense (n_molecules, n_bits) int8 array.
+
+    Parameters
+    ----------
+    instances : List
+        Encoded fingerprints
+    encoding : str
+        Encoding of the instances, see `encode_fps`
+    n_bits : int
+        Number of fingerprint bits, required for `indices` and `packed`
+    keep_packed : bool
+        Return `packed` instances as bit-packed uint8 rows instead of unpacking them
+
+    Returns
+    -------
+    np.ndarray
+        Dense array of fingerprints, bit-packed for `packed` instances if keep_packed is True
+    """
+    if encoding == DENSE:
+        return np.asarray(instances, dtype=np.int8)
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown encoding {encoding}, expected one of {ENCODINGS}.")
+    if n_bits is None:
+        raise ValueError(f"n_bits is required for the {encoding} encoding.")
+    if encoding == INDICES:
+        fps = np.zeros((len(instances), n_bits), np.int8)
+        lengths = [len(x) for x in instances]
+        values = np.concatenate([[]] + instances)
+        if values.dtype.kind not in 'iuf':
+            raise ValueError("Bit indices must be integers.")
+        cols = values.astype(np.int64)
+        if not np.array_equal(cols, values):
+            raise ValueError("Bit indices must be integers.")
+        if len(cols) and (cols.min() < 0 or cols.max() >= n_bits):
+            raise ValueError(f"Bit indices must be between 0 and {n_bits - 1}.")
+        fps[np.repeat(np.arange(len(instances)), lengths), cols] = 1
+        return fps
+    packed = np.frombuffer(b''.join(b64decode(x) for x in instances), np.uint8)
+    packed = packed.reshape(len(instances), (n_bits + 7) // 8)
+    if keep_packed:
+        return packed
+    return np.unpackbits(packed, axis=1, count=n_bits).astype(np.int8)
@@ -0,0 +1,41 @@
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional, Tuple
+import asyncio
+
+THREAD = 'thread'
+PROCESS = 'process'
+EXECUTORS = (THREAD, PROCESS)
+
+
+def make_executor(kind: str = THREAD, workers: int = 0, initializer: Callable = None,
+                  initargs: Tuple = ()) -> Optional[Executor]:
+    """Creates the pool CPU-bound work is offloaded to.
+
+    Parameters
+    ----------
+    kind : str
+        `thread` or `process`
+    workers : int
+        Number of workers. With 0, no pool is created and the work runs inline.
+    initializer, initargs
+        Run once in every worker of a process pool, e.g. to load a model
+
+    Returns
+    -------
+    Optional[Executor]
+        The pool, or None if workers is 0
+    """
+    if workers <= 0:
+        return None
+    if kind == PROCESS:
+        return ProcessPoolExecutor(workers, initializer=initializer, initargs=initargs)
+    if kind == THREAD:
+        return ThreadPoolExecutor(workers)
+    raise ValueError(f"Unknown executor {kind}, expected one of {EXECUTORS}.")
+
+
+async def run_blocking(executor: Optional[Executor], fn: Callable, *args) -> Any:
+    """Runs fn on the executor without blocking the event loop, or inline if there is no executor."""
+    if executor is None:
+        return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
@@ -1,6 +1,7 @@
-from rdkit import DataStructs
+from rdkit import Chem, DataStructs
 from rdkit.Chem import AllChem
 from rdkit.Chem.rdchem import Mol
+from typing import Sequence, Union
 import numpy as np
 
 
@@ -30,3 +31,79 @@ def get_cfps(mol: Mol, radius: int = 1, nBits: int = 1024, useFeatures: bool = F
     DataStructs.ConvertToNumpyArray(
         AllChem.GetMorganFingerprintAsBitVect(mol, radius, nBits=nBits, useFeatures=useFeatures), arr)
     return arr
+
+
+def get_cfps_batch(mols: Sequence[Union[Mol, str]], radius: int = 1, nBits: int = 1024, useFeatures: bool = False,
+                   packed: bool = False, dtype: np.dtype = np.int8) -> np.ndarray:
+    """Calculates circular (Morgan) fingerprints for a batch of molecules into one preallocated array.
+
+    Parameters
+    ----------
+    mols : Sequence[rdkit.Chem.rdchem.Mol | str]
+        Molecules, either as Mol objects or SMILES strings
+    radius : int
+        Fingerprint radius
+    nBits : int
+        Length of hashed fingerprint (without descriptors)
+    useFeatures : bool
+        To get feature fingerprints (FCFP) instead of normal ones (ECFP), defaults to False
+    packed : bool
+        If True, bits are packed into uint8 (8 bits per byte, see np.packbits), defaults to False
+    dtype : np.dtype
+        Numpy data type for the dense array. Ignored when packed is True.
+
+    Returns
+    -------
+    np.ndarray
+        2D array of shape (len(mols), nBits), or (len(mols), ceil(nBits / 8)) of uint8 if packed
+    """
+    if packed:
+        out = np.zeros((len(mols), (nBits + 7) // 8), np.uint8)
+        row = np.zeros((nBits,), np.uint8)
+    else:
+        out = np.zeros((len(mols), nBits), dtype)
+    for i, mol in enumerate(mols):
+        if isinstance(mol, str):
+            mol = Chem.MolFromSmiles(mol)
+        if mol is None:
+            raise ValueError(f"Invalid molecule at position {i}.")
+        on_bits = list(AllChem.GetMorganFingerprintAsBitVect(
+            mol, radius, nBits=nBits, useFeatures=useFeatures).GetOnBits())
+        if packed:
+            row[on_bits] = 1
+            out[i] = np.packbits(row)
+            row[on_bits] = 0
+        else:
+            out[i, on_bits] = 1
+    return out
+
+
+def fold_fps(fps: np.ndarray, nBits: int, foldBits: int, packed: bool = False) -> np.ndarray:
+    """Folds fingerprints to a smaller width by OR-ing consecutive blocks of `foldBits` bits.
+
+    Morgan bits are hashes modulo the width, so for a `foldBits` that divides `nBits` the result equals the
+    fingerprint calculated with `foldBits` directly.
+
+    Parameters
+    ----------
+    fps : np.ndarray
+        2D array of shape (n, nBits), or (n, ceil(nBits / 8)) of uint8 if packed
+    nBits : int
+        Width of the fingerprints
+    foldBits : int
+        Width to fold to, must divide nBits
+    packed : bool
+        If True, fingerprints are bit-packed (see np.packbits) on input and output, defaults to False
+
+    Returns
+    -------
+    np.ndarray
+        2D array of shape (n, foldBits), or (n, ceil(foldBits / 8)) of uint8 if packed
+    """
+    if foldBits <= 0 or nBits % foldBits:
+        raise ValueError(f"Cannot fold {nBits} bits to {foldBits}, the width must divide {nBits}.")
+    if packed and foldBits % 8:
+        return np.packbits(fold_fps(np.unpackbits(fps, axis=1, count=nBits), nBits, foldBits), axis=1)
+    width = foldBits // 8 if packed else foldBits
+    folded = fps.reshape(len(fps), nBits // foldBits, width)
+    return np.bitwise_or.reduce(folded, axis=1) if packed else folded.max(axis=1)
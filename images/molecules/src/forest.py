@@ -0,0 +1,184 @@
+from typing import Dict, Sequence
+import numpy as np
+import struct
+import zipfile
+from sklearn.ensemble import RandomForestClassifier
+
+
+def _memmap_npz(path: str, names: Sequence[str], mode: str = 'r') -> Dict[str, np.memmap]:
+    """Memory-maps arrays of an uncompressed npz file (as written by np.savez), which np.load only reads."""
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for name in names:
+            info = archive.getinfo(f'{name}.npy')
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{name} is compressed in {path} and cannot be memory-mapped.")
+            # the member data follows its local header, whose name and extra field lengths are at offset 26
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            read_header = (np.lib.format.read_array_header_1_0 if version == (1, 0)
+                           else np.lib.format.read_array_header_2_0)
+            shape, fortran_order, dtype = read_header(f)
+            arrays[name] = np.memmap(path, dtype=dtype, mode=mode, offset=f.tell(), shape=shape,
+                                     order='F' if fortran_order else 'C')
+    return arrays
+
+
+class FlatForest:
+    """Random forest classifier flattened into contiguous node arrays, evaluated for all trees at once.
+
+    Nodes of all trees are stored back to back and leaves point to themselves as both children. All (sample, tree)
+    pairs descend one level per vectorized step until they sit in a leaf; once only a few pairs are left (always
+    for small requests) they finish in a plain Python loop, which has less overhead per node than a numpy call.
+    There is no per-tree dispatch and no sklearn input validation.
+
+    Parameters
+    ----------
+    feature : np.ndarray
+        Feature index tested at each node, int32
+    threshold : np.ndarray
+        Threshold of each node (go left if value <= threshold)
+    left, right : np.ndarray
+        Global index of the left and right child of each node, int32
+    value : np.ndarray
+        Class probabilities of each node, of shape (n_nodes, n_classes)
+    roots : np.ndarray
+        Index of the root node of each tree, int32
+    classes : np.ndarray
+        Class labels
+    depth : int
+        Maximum depth of the trees
+    n_features : int
+        Number of input features
+    """
+
+    _PYTHON_CUTOFF = 256  # number of (sample, tree) pairs below which the descent continues in Python
+    _NODE_ARRAYS = ('feature', 'threshold', 'left', 'right', 'value')
+
+    def __init__(self, feature: np.ndarray, threshold: np.ndarray, left: np.ndarray, right: np.ndarray,
+                 value: np.ndarray, roots: np.ndarray, classes: np.ndarray, depth: int, n_features: int):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.classes = classes
+        self.depth = depth
+        self.n_features_in_ = n_features
+        self.is_leaf = left == np.arange(len(left))
+        self._lists = None
+
+    @classmethod
+    def from_sklearn(cls, clf: RandomForestClassifier) -> 'FlatForest':
+        """Flattens a fitted single-output RandomForestClassifier."""
+        feature, threshold, left, right, value, roots = [], [], [], [], [], []
+        offset = 0
+        for estimator in clf.estimators_:
+            tree = estimator.tree_
+            nodes = np.arange(tree.node_count)
+            is_leaf = tree.children_left == -1
+            roots.append(offset)
+            feature.append(np.where(is_leaf, 0, tree.feature))
+            threshold.append(np.where(is_leaf, 0, tree.threshold))
+            left.append(np.where(is_leaf, nodes, tree.children_left) + offset)
+            right.append(np.where(is_leaf, nodes, tree.children_right) + offset)
+            counts = tree.value[:, 0, :]
+            value.append(counts / counts.sum(axis=1, keepdims=True))
+            offset += tree.node_count
+        return cls(feature=np.concatenate(feature).astype(np.int32),
+                   threshold=np.concatenate(threshold),
+                   left=np.concatenate(left).astype(np.int32), right=np.concatenate(right).astype(np.int32),
+                   value=np.concatenate(value), roots=np.array(roots, dtype=np.int32),
+                   classes=clf.classes_, depth=max(e.tree_.max_depth for e in clf.estimators_),
+                   n_features=clf.n_features_in_)
+
+    def save(self, path: str) -> None:
+        """Stores the node arrays as an uncompressed npz file, which `load` can memory-map. No suffix is appended."""
+        with open(path, 'wb') as f:
+            np.savez(f, feature=self.feature, threshold=self.threshold, left=self.left, right=self.right,
+                     value=self.value, roots=self.roots, classes=self.classes, depth=self.depth,
+                     n_features=self.n_features_in_)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: str = None) -> 'FlatForest':
+        """Loads a forest stored by `save`.
+
+        With mmap_mode (see np.memmap), the node arrays are memory-mapped from the file instead of read, so all
+        processes serving the same file share them through the page cache.
+        """
+        with np.load(path) as data:
+            arrays = {k: data[k] for k in ('roots', 'classes', 'depth', 'n_features')}
+            if mmap_mode is None:
+                arrays.update({k: data[k] for k in cls._NODE_ARRAYS})
+        if mmap_mode is not None:
+            arrays.update(_memmap_npz(path, cls._NODE_ARRAYS, mmap_mode))
+        return cls(**{k: arrays[k] for k in ('roots', 'classes') + cls._NODE_ARRAYS},
+                   depth=int(arrays['depth']), n_features=int(arrays['n_features']))
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        """Class probabilities, averaged over the trees.
+
+        Parameters
+        ----------
+        X : np.ndarray
+            Dense (n_samples, n_features) array, or bit-packed fingerprints as uint8 of shape
+            (n_samples, ceil(n_features / 8)) as returned by np.packbits
+
+        Returns
+        -------
+        np.ndarray
+            Array of shape (n_samples, n_classes)
+        """
+        X = np.asarray(X)
+        packed = X.ndim == 2 and X.dtype == np.uint8 and X.shape[1] == (self.n_features_in_ + 7) // 8
+        if not packed and (X.ndim != 2 or X.shape[1] != self.n_features_in_):
+            raise ValueError(f"X has shape {X.shape}, but FlatForest is expecting {self.n_features_in_} "
+                             f"features as input.")
+        nodes = np.tile(self.roots, len(X))
+        samples = np.repeat(np.arange(len(X)), len(self.roots))
+        # only pairs that have not reached a leaf yet are stepped
+        active = np.flatnonzero(~self.is_leaf[nodes])
+        while len(active) > self._PYTHON_CUTOFF:
+            current = nodes[active]
+            feature = self.feature[current]
+            if packed:
+                # the bit of each feature is tested in its byte, most significant bit first as in np.packbits
+                value = (X[samples[active], feature >> 3] >> (7 - (feature & 7)).astype(np.uint8)) & 1
+            else:
+                value = X[samples[active], feature]
+            go_right = value > self.threshold[current]
+            current = np.where(go_right, self.right[current], self.left[current])
+            nodes[active] = current
+            active = active[~self.is_leaf[current]]
+        if len(active):
+            self._descend(X, nodes, samples, active, packed)
+        return self.value[nodes].reshape(len(X), len(self.roots), len(self.classes)).mean(axis=1)
+
+    def _descend(self, X: np.ndarray, nodes: np.ndarray, samples: np.ndarray, active: np.ndarray,
+                 packed: bool = False) -> None:
+        if self._lists is None:
+            # memoryviews index a bit slower than lists, but read memory-mapped nodes without copying them
+            self._lists = tuple(memoryview(a).cast('B').cast(a.dtype.char) if isinstance(a, np.memmap) else a.tolist()
+                                for a in (self.feature, self.threshold, self.left, self.right))
+        feature, threshold, left, right = self._lists
+        rows = {}
+        for i in active.tolist():
+            sample = samples[i]
+            if sample not in rows:
+                # the few rows left for the Python loop are unpacked one by one
+                rows[sample] = (np.unpackbits(X[sample], count=self.n_features_in_) if packed else X[sample]).tolist()
+            row = rows[sample]
+            node = nodes[i]
+            while left[node] != node:
+                node = left[node] if row[feature[node]] <= threshold[node] else right[node]
+            nodes[i] = node
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        """Predicted class labels, see `predict_proba` for the accepted inputs."""
+        return self.classes[self.predict_proba(X).argmax(axis=1)]
+
+    def __str__(self) -> str:
+        return f"FlatForest(n_estimators={len(self.roots)}, n_nodes={len(self.feature)}, depth={self.depth})"
@@ -0,0 +1,74 @@
+from contextlib import contextmanager
+from prometheus_client import REGISTRY, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+import time
+
+# Registered with the default prometheus_client registry, which KServe's model server exposes on /metrics
+PROM_LABELS = ['model_name', 'stage']
+
+PARSE = 'parse'  # SMILES to RDKit molecules
+FINGERPRINT = 'fingerprint'  # molecules to fingerprints
+CACHE = 'cache'  # parsing, canonicalization and lookups of the persistent fingerprint cache
+SERIALIZE = 'serialize'  # fingerprints to the payload sent to the predictor
+DESERIALIZE = 'deserialize'  # compact payload back to fingerprints
+ROUND_TRIP = 'predictor_round_trip'  # transformer to predictor and back
+PREDICT = 'predict'  # model.predict, including any wait for a free pool worker
+REQUEST = 'request'
+
+STAGE_SECONDS = Histogram(
+    'mol_stage_seconds', 'Latency of a serving stage', PROM_LABELS,
+    buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.))
+BATCH_SIZE = Histogram(
+    'mol_batch_size', 'Molecules per request (stage=request) or per model.predict call (stage=predict)', PROM_LABELS,
+    buckets=tuple(2 ** i for i in range(13)))
+
+
+def observe(model_name: str, stage: str, seconds: float) -> None:
+    STAGE_SECONDS.labels(model_name=model_name, stage=stage).observe(seconds)
+
+
+def observe_batch(model_name: str, stage: str, size: int) -> None:
+    BATCH_SIZE.labels(model_name=model_name, stage=stage).observe(size)
+
+
+@contextmanager
+def timed(model_name: str, stage: str):
+    """Observes the duration of the enclosed block for the given stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(model_name, stage, time.perf_counter() - start)
+
+
+class CacheCollector:
+    """Exports the counters of the fingerprint caches, read from their `stats()` whenever /metrics is scraped."""
+
+    def __init__(self):
+        self._caches = {}
+
+    def add(self, model_name: str, cache_name: str, cache) -> None:
+        # keyed by name, so a model created again under the same name replaces the old cache
+        self._caches[model_name, cache_name] = cache
+
+    def collect(self):
+        labels = ['model_name', 'cache']
+        counters = {name: CounterMetricFamily(f'mol_cache_{name}', f'Fingerprint cache {name}', labels=labels)
+                    for name in ('hits', 'misses', 'evictions')}
+        size = GaugeMetricFamily('mol_cache_entries', 'Fingerprints held by the cache', labels=labels)
+        for (model_name, cache_name), cache in list(self._caches.items()):
+            stats = cache.stats()
+            for name, counter in counters.items():
+                counter.add_metric([model_name, cache_name], stats[name])
+            size.add_metric([model_name, cache_name], stats['size'])
+        yield from counters.values()
+        yield size
+
+
+CACHES = CacheCollector()
+REGISTRY.register(CACHES)
+
+
+def register_cache(model_name: str, cache_name: str, cache) -> None:
+    """Exports the hit, miss and eviction counts and the size of a cache with a `stats()` method."""
+    CACHES.add(model_name, cache_name, cache)
@@ -1,48 +1,286 @@
+import asyncio
 import joblib
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
 from kserve import Model, constants
-from kserve.errors import InferenceError, ModelMissingError
-from typing import Dict
-import logging
+from kserve.errors import InferenceError, InvalidInput, ModelMissingError
 from rdkit import Chem
-from .features import get_cfps
+from typing import Dict, List, Tuple
+import logging
+import numpy as np
+import time
+from .batching import MicroBatcher
+from .cache import FingerprintCache, LRUCache
+from .encoding import DENSE, decode_fps, encode_fps
+from .executors import PROCESS, THREAD, make_executor, run_blocking
+from .features import get_cfps_batch
+from .forest import FlatForest
+from .metrics import (CACHE, DESERIALIZE, FINGERPRINT, PARSE, PREDICT, REQUEST, ROUND_TRIP, SERIALIZE, observe,
+                      observe_batch, register_cache, timed)
 import os
+import zipfile
 
 
 logging.basicConfig(level=constants.KSERVE_LOGLEVEL)
 
+_worker_model = None
+
+
+def load_model(path: str, mmap_mode: str = None):
+    """Loads a FlatForest exported by `chem-util.py export` (npz) or a joblib model.
+
+    mmap_mode only applies to a FlatForest: sklearn trees copy their node arrays into their own buffers when
+    unpickled, so a memory-mapped joblib file would still be copied into every process.
+    """
+    if zipfile.is_zipfile(path):
+        return FlatForest.load(path, mmap_mode=mmap_mode)
+    if mmap_mode is not None:
+        logging.warning(f"Memory mapping is only supported for models exported with `chem-util.py export`, "
+                        f"loading {path} into memory.")
+    return joblib.load(path)
+
+
+def _load_worker_model(path: str, mmap_mode: str = None) -> None:
+    global _worker_model
+    _worker_model = load_model(path, mmap_mode=mmap_mode)
+
+
+def _predict_in_worker(instances: np.ndarray) -> np.ndarray:
+    return _worker_model.predict(instances)
+
+
+def _timed_cfps(smiles: List[str], n_bits: int, packed: bool) -> Tuple[np.ndarray, float, float]:
+    """Fingerprints SMILES, also returning the seconds spent on parsing and on fingerprinting."""
+    start = time.perf_counter()
+    mols = [Chem.MolFromSmiles(s) for s in smiles]
+    parsed = time.perf_counter()
+    fps = get_cfps_batch(mols, nBits=n_bits, packed=packed)
+    return fps, parsed - start, time.perf_counter() - parsed
+
+
+def _timed(fn, *args) -> Tuple[np.ndarray, float]:
+    start = time.perf_counter()
+    return fn(*args), time.perf_counter() - start
+
+
+class MolFeaturizer:
+    """Fingerprints batches of SMILES, optionally through an in-memory LRU and a persistent fingerprint cache."""
+
+    def __init__(self, n_bits: int = 1024, cache_path: str = None, cache_size: int = 1_000_000, lru_size: int = 0,
+                 executor: Executor = None, name: str = ''):
+        self.n_bits = n_bits
+        self.name = name  # model name the stage timings are recorded under
+        self.cache = FingerprintCache(cache_path, max_entries=cache_size) if cache_path else None
+        self.lru = LRUCache(lru_size) if lru_size > 0 else None
+        self.executor = executor
+        if self.cache is not None:
+            register_cache(name, 'persistent', self.cache)
+        if self.lru is not None:
+            register_cache(name, 'lru', self.lru)
+
+    async def __call__(self, smiles: List[str]) -> np.ndarray:
+        """Fingerprints a whole batch of SMILES into one (len(smiles), n_bits) array."""
+        try:
+            if self.lru is None or not smiles:
+                return await self._calculate(smiles)
+            # the LRU cache holds bit-packed rows keyed by the SMILES as sent by the client
+            rows = [self.lru.get(s) for s in smiles]
+            missing = [i for i, row in enumerate(rows) if row is None]
+            if missing:
+                try:
+                    fps = await self._calculate([smiles[i] for i in missing], packed=True)
+                except ValueError:
+                    # the error counts positions among the misses, the client needs the one in its request
+                    for i in missing:
+                        if Chem.MolFromSmiles(smiles[i]) is None:
+                            raise ValueError(f"Invalid molecule at position {i}.")
+                    raise
+                for i, row in zip(missing, fps):
+                    rows[i] = row.copy()
+                    self.lru.put(smiles[i], rows[i])
+            return np.unpackbits(np.stack(rows), axis=1, count=self.n_bits).astype(np.int8, copy=False)
+        except ValueError as e:
+            raise InvalidInput(str(e))
+
+    async def _calculate(self, smiles: List[str], packed: bool = False) -> np.ndarray:
+        if self.cache is None:
+            # timed where the work runs, which may be another process
+            fps, parse_seconds, fp_seconds = await run_blocking(self.executor, _timed_cfps, smiles, self.n_bits,
+                                                                packed)
+            observe(self.name, PARSE, parse_seconds)
+            observe(self.name, FINGERPRINT, fp_seconds)
+            return fps
+        fps = partial(get_cfps_batch, nBits=self.n_bits, packed=True)
+        if not isinstance(self.executor, ProcessPoolExecutor):
+            calculate = partial(_timed, fps)
+            run = partial(run_blocking, self.executor)
+        else:
+            # the SQLite cache lives in this process: lookups run on a thread, only misses go to the process pool
+            calculate = partial(_timed, lambda mols: self.executor.submit(fps, mols).result())
+            run = partial(asyncio.get_running_loop().run_in_executor, None)
+        fp_seconds = 0.
+
+        def calculate_misses(mols):
+            nonlocal fp_seconds
+            out, fp_seconds = calculate(mols)
+            return out
+
+        start = time.perf_counter()
+        out = await run(partial(self.cache.get_cfps_batch, smiles, nBits=self.n_bits, packed=packed,
+                                calculate=calculate_misses))
+        observe(self.name, CACHE, time.perf_counter() - start - fp_seconds)
+        if fp_seconds:
+            observe(self.name, FINGERPRINT, fp_seconds)
+        return out
+
 
 class MolTransformer(Model):
-    def __init__(self, name: str, predictor_host: str, n_bits: int = 1024, headers: Dict[str, str] = None):
+    def __init__(self, name: str, predictor_host: str, n_bits: int = 1024, headers: Dict[str, str] = None,
+                 cache_path: str = None, cache_size: int = 1_000_000, lru_size: int = 0, encoding: str = DENSE,
+                 workers: int = 0, executor: str = THREAD):
         super().__init__(name)
         self.predictor_host = predictor_host
         self.n_bits = n_bits
+        self.encoding = encoding
+        self.featurizer = MolFeaturizer(n_bits, cache_path=cache_path, cache_size=cache_size, lru_size=lru_size,
+                                        executor=make_executor(executor, workers), name=name)
         self.ready = True
 
-    def preprocess(self, inputs: Dict, headers: Dict[str, str] = None) -> Dict:
-        return {'instances': [[x.item() for x in get_cfps(Chem.MolFromSmiles(instance), nBits=self.n_bits)] for
-                              instance in inputs['instances']]}
+    async def preprocess(self, inputs: Dict, headers: Dict[str, str] = None) -> Dict:
+        observe_batch(self.name, REQUEST, len(inputs['instances']))
+        fps = await self.featurizer(inputs['instances'])
+        with timed(self.name, SERIALIZE):
+            if self.encoding == DENSE:
+                # plain payload, understood by any predictor
+                return {'instances': encode_fps(fps)}
+            # compact payloads name their encoding so that MolPredictor can decode them
+            return {'instances': encode_fps(fps, self.encoding), 'encoding': self.encoding, 'n_bits': self.n_bits}
+
+    async def predict(self, payload: Dict, headers: Dict[str, str] = None) -> Dict:
+        with timed(self.name, ROUND_TRIP):
+            if 'encoding' not in payload:
+                return await super().predict(payload, headers)
+            try:
+                return await super().predict(payload, headers)
+            except Exception as e:
+                # a predictor older than the compact encodings fails on them, but still reads dense payloads
+                fps = decode_fps(payload['instances'], payload['encoding'], payload['n_bits'])
+                response = await super().predict({'instances': encode_fps(fps)}, headers)
+                logging.warning(f"Predictor failed on a {payload['encoding']} payload ({e!r}) but accepted it dense, "
+                                f"sending dense payloads from now on.")
+                self.encoding = DENSE
+                return response
 
     def postprocess(self, inputs: Dict, headers: Dict[str, str] = None) -> Dict:
         return inputs
 
 
 class MolPredictor(Model):
-    def __init__(self, name: str):
+    def __init__(self, name: str, max_batch_size: int = 0, max_batch_wait_ms: float = 5.0, workers: int = 0,
+                 executor: str = THREAD, mmap: bool = False, warmup_rows: int = 0):
         super().__init__(name)
         self.name = name
         self.ready = False
+        # KServe's storage initializer downloads the model to /mnt/models, MODEL_DIR points elsewhere for local runs
+        self.model_path = os.path.join(os.environ.get('MODEL_DIR', '/mnt/models'), os.environ["MODEL_FILENAME"])
+        # a memory-mapped FlatForest shares its node arrays with other replicas and pool workers via the page cache
+        self.mmap_mode = 'r' if mmap else None
+        self.warmup_rows = warmup_rows
+        self.load_seconds = None
+        self.warmup_seconds = None
+        # with workers > 0, model.predict runs on a pool and no longer blocks the event loop; every worker
+        # of a process pool loads its own copy of the model
+        self.workers = workers
+        self.in_process_pool = executor == PROCESS and workers > 0
+        self.executor = make_executor(executor, workers, initializer=_load_worker_model,
+                                      initargs=(self.model_path, self.mmap_mode))
         self.load()
+        # with max_batch_size > 0, concurrent requests are merged into one model.predict call
+        self.batcher = MicroBatcher(self.predict_fn, max_batch_size=max_batch_size, max_wait_ms=max_batch_wait_ms,
+                                    executor=self.executor,
+                                    observe=self.observe_predict) if max_batch_size > 0 else None
 
     def load(self):
-        self.model = joblib.load(f'/mnt/models/{os.environ["MODEL_FILENAME"]}')
+        start = time.perf_counter()
+        self.model = load_model(self.model_path, mmap_mode=self.mmap_mode)
+        self.load_seconds = time.perf_counter() - start
+        self.predict_fn = _predict_in_worker if self.in_process_pool else self.model.predict
+        print(f"Loaded {self.model.__str__()} in {self.load_seconds:.3f}s")
+        if self.warmup_rows > 0:
+            start = time.perf_counter()
+            self.warmup()
+            self.warmup_seconds = time.perf_counter() - start
+            print(f"Warmed up on {self.warmup_rows} synthetic fingerprints in {self.warmup_seconds:.3f}s")
         self.ready = True
-        print(f"Loaded {self.model.__str__()}")
         return self.ready
 
-    def predict(self, payload: Dict, headers: Dict[str, str] = None) -> Dict:
+    def warmup(self):
+        """Predicts on random sparse fingerprints, so the first real request does not pay cold-start costs."""
+        rng = np.random.default_rng(0)
+        instances = (rng.random((self.warmup_rows, self.model.n_features_in_)) < 0.02).astype(np.int8)
+        self.model.predict(instances)
+        if self.executor is not None:
+            # pool workers start lazily, one call per worker starts them (and loads the model in process pools)
+            for future in [self.executor.submit(self.predict_fn, instances) for _ in range(self.workers)]:
+                future.result()
+
+    def observe_predict(self, n_rows: int, seconds: float) -> None:
+        """Records the batch size and duration of a model.predict call."""
+        observe_batch(self.name, PREDICT, n_rows)
+        observe(self.name, PREDICT, seconds)
+
+    def as_rows(self, instances) -> np.ndarray:
+        """Dense int8 rows of the model's width, so that requests of any encoding can share a batch."""
+        try:
+            rows = np.asarray(instances, dtype=np.int8)
+        except (ValueError, TypeError) as e:
+            raise InvalidInput(str(e))
+        if rows.ndim != 2 or rows.shape[1] != self.model.n_features_in_:
+            raise InvalidInput(f"Instances have shape {rows.shape}, but the model is expecting "
+                               f"{self.model.n_features_in_} features per row.")
+        return rows
+
+    async def predict(self, payload: Dict, headers: Dict[str, str] = None) -> Dict:
         instances = payload["instances"]
+        if "encoding" in payload:
+            try:
+                with timed(self.name, DESERIALIZE):
+                    # a FlatForest evaluates packed bits directly, unless they are batched with dense rows
+                    instances = decode_fps(instances, payload["encoding"], payload.get("n_bits"),
+                                           keep_packed=isinstance(self.model, FlatForest) and self.batcher is None)
+            except (ValueError, TypeError) as e:
+                raise InvalidInput(str(e))
+        if self.batcher is not None:
+            instances = self.as_rows(instances)
         try:
-            result = self.model.predict(instances).tolist()
+            if self.batcher is not None:
+                result = (await self.batcher.submit(instances)).tolist()
+            else:
+                start = time.perf_counter()
+                result = await run_blocking(self.executor, self.predict_fn, instances)
+                self.observe_predict(len(result), time.perf_counter() - start)
+                result = result.tolist()
             return {"predictions": result}
         except Exception as e:
             raise InferenceError(str(e))
+
+
+class MolClassifier(MolPredictor):
+    """Fingerprinting and prediction in a single model, without the transformer to predictor round-trip.
+
+    Requests carry SMILES like the ones sent to `MolTransformer`. They are fingerprinted in `predict`, so the
+    fingerprints are passed to the model as an array and never serialized.
+    """
+
+    def __init__(self, name: str, n_bits: int = 1024, cache_path: str = None, cache_size: int = 1_000_000,
+                 lru_size: int = 0, max_batch_size: int = 0, max_batch_wait_ms: float = 5.0, workers: int = 0,
+                 executor: str = THREAD, mmap: bool = False, warmup_rows: int = 0):
+        super().__init__(name, max_batch_size=max_batch_size, max_batch_wait_ms=max_batch_wait_ms, workers=workers,
+                         executor=executor, mmap=mmap, warmup_rows=warmup_rows)
+        # fingerprinting shares the pool with the model
+        self.featurizer = MolFeaturizer(n_bits, cache_path=cache_path, cache_size=cache_size, lru_size=lru_size,
+                                        executor=self.executor, name=name)
+
+    async def predict(self, payload: Dict, headers: Dict[str, str] = None) -> Dict:
+        observe_batch(self.name, REQUEST, len(payload['instances']))
+        return await super().predict({'instances': await self.featurizer(payload['instances'])}, headers)
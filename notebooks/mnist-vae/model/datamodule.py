@@ -1,10 +1,96 @@
-from typing import Optional
+import os
+from typing import Optional, Sequence, Tuple, Union
 import pytorch_lightning as pl
-from torch.utils.data import DataLoader
+import torch
+from torch.utils.data import (
+    BatchSampler,
+    DataLoader,
+    Dataset,
+    RandomSampler,
+    SequentialSampler,
+)
 from torchvision.datasets import MNIST
 from torchvision.transforms import transforms
 
 
+class TensorMNIST(Dataset):
+    """
+    MNIST held as one contiguous tensor, indexed by single samples or whole batches.
+
+    Indexing with a sequence of indices gathers the whole batch with a single
+    tensor operation, instead of one PIL to tensor conversion per sample.
+
+    Attributes:
+        images (torch.Tensor): Images of shape (N, 1, 28, 28), uint8 or float32.
+        targets (torch.Tensor): Labels of shape (N,).
+    """
+
+    def __init__(self, images: torch.Tensor, targets: torch.Tensor):
+        self.images = images
+        self.targets = targets
+
+    @classmethod
+    def from_cache(
+        cls, data_path: str, train: bool, dtype: str = "uint8"
+    ) -> "TensorMNIST":
+        """
+        Loads the tensor cache of a split, converting MNIST into it first if needed.
+
+        The cache is a `.pt` file under `<data_path>/MNIST/tensors`, which is
+        memory-mapped on load rather than read into memory.
+
+        Args:
+            data_path (str): Path to the directory where the MNIST data is
+                stored.
+            train (bool): Whether to load the training or the test split.
+            dtype (str): 'uint8' to store the raw pixels, scaled when a batch
+                is served, or 'float32' to store them scaled to [0, 1] (4x the
+                size on disk).
+
+        Returns:
+            TensorMNIST: The dataset backed by the cache.
+        """
+        if dtype not in ("uint8", "float32"):
+            raise ValueError(f"dtype should be 'uint8' or 'float32', got {dtype}")
+        cache_dir = os.path.join(data_path, "MNIST", "tensors")
+        path = os.path.join(cache_dir, f"{'train' if train else 'test'}_{dtype}.pt")
+        if not os.path.exists(path):
+            mnist = MNIST(data_path, train=train, download=True)
+            images = mnist.data.unsqueeze(1).contiguous()
+            if dtype == "float32":
+                # the same values as transforms.ToTensor
+                images = images.float().div_(255)
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            torch.save({"images": images, "targets": mnist.targets.clone()}, tmp_path)
+            os.replace(tmp_path, path)
+        data = torch.load(path, mmap=True)
+        return cls(data["images"], data["targets"])
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    def __getitem__(
+        self, index: Union[int, Sequence[int]]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns images scaled to [0, 1] and labels of a sample or a batch.
+
+        Args:
+            index (Union[int, Sequence[int]]): A sample index, or the indices
+                of a batch.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: Image(s) and label(s).
+        """
+        if not isinstance(index, int):
+            index = torch.as_tensor(index)
+        images = self.images[index]
+        if images.dtype == torch.uint8:
+            images = images.float().div_(255)
+        return images, self.targets[index]
+
+
 class MNISTDataModule(pl.LightningDataModule):
     """
     PyTorch Lightning Data Module for the MNIST dataset.
@@ -17,10 +103,16 @@ class MNISTDataModule(pl.LightningDataModule):
         stored.
         num_workers (int): Number of subprocesses to use for data loading.
         batch_size (int): How many samples per batch to load.
+        tensor_cache (Optional[str]): If set, serve batches from a tensor
+        cache of this dtype ('uint8' or 'float32'), see `TensorMNIST`.
     """
 
     def __init__(
-        self, data_path: str = "./data", num_workers: int = 4, batch_size: int = 32
+        self,
+        data_path: str = "./data",
+        num_workers: int = 4,
+        batch_size: int = 32,
+        tensor_cache: Optional[str] = None,
     ):
         """
         Initializes the MNISTDataModule.
@@ -30,11 +122,16 @@ class MNISTDataModule(pl.LightningDataModule):
                 stored.
             num_workers (int): Number of subprocesses to use for data loading.
             batch_size (int): How many samples per batch to load.
+            tensor_cache (Optional[str]): If set, MNIST is converted once into
+                a tensor cache of this dtype ('uint8' or 'float32') on disk,
+                and whole batches are served from it by indexing, without
+                per-sample transforms.
         """
         super().__init__()
         self.data_path = data_path
         self.num_workers = num_workers
         self.batch_size = batch_size
+        self.tensor_cache = tensor_cache
         self.train_dataset = None
         self.val_dataset = None
 
@@ -46,6 +143,15 @@ class MNISTDataModule(pl.LightningDataModule):
             stage (Optional[str]): Stage - either 'fit' or 'test'. If None,
                 setup will prepare all datasets.
         """
+        if self.tensor_cache:
+            self.train_dataset = TensorMNIST.from_cache(
+                self.data_path, train=True, dtype=self.tensor_cache
+            )
+            self.val_dataset = TensorMNIST.from_cache(
+                self.data_path, train=False, dtype=self.tensor_cache
+            )
+            return
+
         # Define the transform to apply to each data point
         transform = transforms.Compose([transforms.ToTensor()])
 
@@ -64,6 +170,10 @@ class MNISTDataModule(pl.LightningDataModule):
         Returns:
             DataLoader: The DataLoader for the MNIST training dataset.
         """
+        if self.tensor_cache:
+            return self._batch_loader(
+                self.train_dataset, RandomSampler(self.train_dataset)
+            )
         return DataLoader(
             self.train_dataset,
             batch_size=self.batch_size,
@@ -78,8 +188,24 @@ class MNISTDataModule(pl.LightningDataModule):
         Returns:
             DataLoader: The DataLoader for the MNIST validation dataset.
         """
+        if self.tensor_cache:
+            return self._batch_loader(
+                self.val_dataset, SequentialSampler(self.val_dataset)
+            )
         return DataLoader(
             self.val_dataset,
             batch_size=self.batch_size,
             num_workers=self.num_workers,
         )
+
+    def _batch_loader(self, dataset: TensorMNIST, sampler) -> DataLoader:
+        """
+        Returns a DataLoader that fetches every batch with a single index
+        operation on the dataset, with automatic batching turned off.
+        """
+        return DataLoader(
+            dataset,
+            sampler=BatchSampler(sampler, batch_size=self.batch_size, drop_last=False),
+            batch_size=None,
+            num_workers=self.num_workers,
+        )
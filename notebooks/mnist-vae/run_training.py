@@ -8,17 +8,20 @@ import torch
 @click.command()
 @click.option('--hidden_dim', default=400, type=int, help='Dimension of the hidden layer.')
 @click.option('--latent_dim', default=2, type=int, help='Dimension of the latent space.')
-def run(hidden_dim: int, latent_dim: int) -> None:
+@click.option('--tensor_cache', default=None, type=click.Choice(['uint8', 'float32']),
+              help='Serve batches from a tensor cache of MNIST with this dtype.')
+def run(hidden_dim: int, latent_dim: int, tensor_cache: str) -> None:
     """
     Train a VAE model on the MNIST dataset using PyTorch Lightning.
 
     Args:
         hidden_dim (int): Dimension of the hidden layer.
         latent_dim (int): Dimension of the latent space.
+        tensor_cache (str): dtype of the MNIST tensor cache, None to read the images with torchvision.
     """
 
     # Initialize data module
-    dm = MNISTDataModule(data_path="./data", num_workers=0, batch_size=32)
+    dm = MNISTDataModule(data_path="./data", num_workers=0, batch_size=32, tensor_cache=tensor_cache)
     dm.setup()
 
     # Initialize model
@@ -0,0 +1,101 @@
+import sys
+import pathlib
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+
+from utils.auth_session import get_istio_auth_session
+import argparse
+import datetime
+import hashlib
+import inspect
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import kfp
+from kfp.client import Client
+from kfp import compiler
+import pipeline
+from pipeline import container_components_pipeline
+
+
+def compile_pipeline(package_path: str) -> bool:
+    """Compiles the pipeline unless package_path was compiled from the same source and kfp version.
+
+    The hash of the source is kept next to the package, in `<package_path>.sha256`.
+
+    :return: True if the pipeline was compiled
+    """
+    with open(inspect.getsourcefile(pipeline), 'rb') as f:
+        source_hash = hashlib.sha256(f.read() + kfp.__version__.encode()).hexdigest()
+    hash_path = f'{package_path}.sha256'
+    if os.path.exists(package_path) and os.path.exists(hash_path):
+        with open(hash_path) as f:
+            if f.read() == source_hash:
+                return False
+    compiler.Compiler().compile(container_components_pipeline, package_path)
+    with open(hash_path, 'w') as f:
+        f.write(source_hash)
+    return True
+
+
+def read_argument_sets(path: str) -> list:
+    """Reads pipeline arguments from a JSON list of objects, or from JSON Lines with one object per line."""
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Creates one run of the pipeline per argument set, concurrently.")
+    parser.add_argument('arguments', help="JSON file with a list of argument objects, or JSON Lines file")
+    parser.add_argument('--concurrency', '-c', type=int, default=8, help="Number of runs created at once")
+    parser.add_argument('--package', '-p', default='pipeline.yaml', help="Path of the compiled pipeline")
+    parser.add_argument('--experiment', '-e', default='minimal-container-components-experiment',
+                        help="Experiment the runs are created in")
+    args = parser.parse_args()
+
+    argument_sets = read_argument_sets(args.arguments)
+    if compile_pipeline(args.package):
+        print(f"Compiled the pipeline to {args.package}")
+    else:
+        print(f"Pipeline source unchanged, reusing {args.package}")
+
+    auth_session = get_istio_auth_session(
+        url=os.environ['KUBEFLOW_ENDPOINT'],
+        username=os.environ['KUBEFLOW_USERNAME'],
+        password=os.environ['KUBEFLOW_PASSWORD']
+    )
+    namespace = os.environ.get('KUBEFLOW_NAMESPACE', None) or \
+        os.environ['KUBEFLOW_USERNAME'].split("@")[0].replace(".", "-")
+    client = Client(host=f"{os.environ['KUBEFLOW_ENDPOINT']}/pipeline", namespace=namespace,
+                    cookies=auth_session["session_cookie"], verify_ssl=False)
+    # created once up front, concurrent runs would otherwise race to create it
+    experiment = client.create_experiment(args.experiment, namespace=namespace)
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def submit(i):
+        return client.run_pipeline(
+            experiment_id=experiment.experiment_id,
+            job_name=f'Simple pipeline {timestamp} #{i}',
+            pipeline_package_path=args.package,
+            params=argument_sets[i],
+            enable_caching=False
+        )
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(submit, i) for i in range(len(argument_sets))]
+        for i, future in enumerate(futures):
+            try:
+                print(f"#{i} {argument_sets[i]}: run {future.result().run_id}")
+            except Exception as e:
+                failed += 1
+                print(f"#{i} {argument_sets[i]}: failed with {e}")
+    print(f"Created {len(argument_sets) - failed} of {len(argument_sets)} runs")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
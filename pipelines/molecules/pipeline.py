@@ -1,6 +1,7 @@
 from kfp import dsl
 from kfp.dsl import Input, Output, Dataset, Markdown, Model, Metrics
 from kfp import compiler
+from typing import List
 import os
 
 # You will likely want to set COMPONENTS_IMAGE env var accordingly
@@ -18,28 +19,37 @@ def preprocess(input_data: Input[Dataset], output: Output[Dataset], viz: Output[
         args=["preprocess", "-i", input_data.path, "-o", output.path, "-s", viz.path, '--fp-bits', n_bits])
 
 
+@dsl.container_component
+def fold(input_data: Input[Dataset], output: Output[Dataset], n_bits: int):
+    return dsl.ContainerSpec(
+        image=COMPONENTS_IMAGE,
+        command=["/opt/conda/bin/python", "chem-util.py"],
+        args=["fold", "-i", input_data.path, "-o", output.path, '--fp-bits', n_bits])
+
+
 @dsl.container_component
 def split(input_data: Input[Dataset], output_train: Output[Dataset], output_test: Output[Dataset]):
     return dsl.ContainerSpec(
         image=COMPONENTS_IMAGE,
         command=["/opt/conda/bin/python", "chem-util.py"],
-        args=["split", "-i", input_data.path, "-o", output_train.path, "-t", output_test.path])
+        args=["split", "-i", input_data.path, "-o", output_train.path, "-t", output_test.path, "--indices-only"])
 
 
 @dsl.container_component
-def train(input_data: Input[Dataset], output: Output[Model], n_trees: int):
+def train(input_data: Input[Dataset], indices: Input[Dataset], output: Output[Model], n_trees: int):
     return dsl.ContainerSpec(
         image=COMPONENTS_IMAGE,
         command=["/opt/conda/bin/python", "chem-util.py"],
-        args=["train", "-i", input_data.path, "-o", output.path, "--n-trees", n_trees])
+        args=["train", "-i", input_data.path, "-x", indices.path, "-o", output.path, "--n-trees", n_trees])
 
 
 @dsl.container_component
-def evaluate(input_data: Input[Dataset], model: Input[Model], metric: dsl.OutputPath(float)):
+def evaluate(input_data: Input[Dataset], indices: Input[Dataset], model: Input[Model],
+             metric: dsl.OutputPath(float)):
     return dsl.ContainerSpec(
         image=COMPONENTS_IMAGE,
         command=["/opt/conda/bin/python", "chem-util.py"],
-        args=["evaluate", "-i", input_data.path, "-m", model.path, "-o", metric])
+        args=["evaluate", "-i", input_data.path, "-x", indices.path, "-m", model.path, "-o", metric])
 
 
 @dsl.component
@@ -57,10 +67,32 @@ def chem_classification_pipeline(n_bits: int, n_trees: int):
     )
     preprocessed = preprocess(input_data=importer.output, n_bits=n_bits)
     split_data = split(input_data=preprocessed.outputs['output'])
-    train_model = train(input_data=split_data.outputs['output_train'], n_trees=n_trees)
-    metric = evaluate(input_data=split_data.outputs['output_test'], model=train_model.output)
+    train_model = train(input_data=preprocessed.outputs['output'], indices=split_data.outputs['output_train'],
+                        n_trees=n_trees)
+    metric = evaluate(input_data=preprocessed.outputs['output'], indices=split_data.outputs['output_test'],
+                      model=train_model.output)
     report_metric(metric=metric.outputs['metric'])
 
 
+@dsl.pipeline
+def chem_classification_sweep_pipeline(max_n_bits: int, n_bits: List[int], n_trees: int):
+    # fingerprints are calculated once with max_n_bits and folded to every value of n_bits, each must divide it
+    importer = dsl.importer(
+        artifact_uri='minio://kubeflow-examples/data/molecules/ames.csv.zip',
+        artifact_class=dsl.Dataset,
+        reimport=True,
+    )
+    preprocessed = preprocess(input_data=importer.output, n_bits=max_n_bits)
+    # the split only depends on the rows, all widths share it
+    split_data = split(input_data=preprocessed.outputs['output'])
+    with dsl.ParallelFor(n_bits) as bits:
+        folded = fold(input_data=preprocessed.outputs['output'], n_bits=bits)
+        train_model = train(input_data=folded.output, indices=split_data.outputs['output_train'], n_trees=n_trees)
+        metric = evaluate(input_data=folded.output, indices=split_data.outputs['output_test'],
+                          model=train_model.output)
+        report_metric(metric=metric.outputs['metric'])
+
+
 if __name__ == "__main__":
     compiler.Compiler().compile(chem_classification_pipeline, 'pipeline.yaml')
+    compiler.Compiler().compile(chem_classification_sweep_pipeline, 'sweep-pipeline.yaml')
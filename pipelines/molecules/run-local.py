@@ -0,0 +1,269 @@
+"""Runs chem_classification_pipeline on this machine, without containers or a Kubeflow cluster.
+
+The steps are read from the pipeline compiled from `pipeline.py`, so they match what runs on Kubeflow. They call the
+chem-util commands directly and run on a process pool as soon as their inputs are ready, so independent steps (e.g.
+the models of several n_bits/n_trees values) run concurrently. Every step stores its outputs in a cache directory
+under a hash of its arguments, inputs and the code of chem-util (chem-util.py and its `src` package); a step whose
+hash already has results is skipped, also across runs. The input data is hashed by its content.
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import lru_cache
+from itertools import product
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from kfp import compiler
+import click
+import glob
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import yaml
+
+# the image only matters on a cluster, but pipeline.py requires it
+os.environ.setdefault('COMPONENTS_IMAGE', 'local')
+import pipeline  # noqa: E402
+
+CHEM_UTIL = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'images', 'molecules',
+                         'chem-util.py')
+
+# argument placeholders of the compiled container components, e.g. {{$.inputs.artifacts['input_data'].path}}
+PLACEHOLDER = re.compile(r"\{\{\$\.(inputs|outputs)\.(artifacts|parameters)\['([^']+)'\](?:\.path|\.output_file)?\}\}")
+
+_chem_util = None
+
+
+class Step:
+    """One chem-util command of the pipeline.
+
+    Parameters
+    ----------
+    name : str
+        Name of the step, also used in the name of its cache directory
+    args : List[str | Tuple[Step, str]]
+        chem-util arguments: strings, outputs of upstream steps as (step, output name) and outputs of this step as
+        (None, output name)
+    path : str, optional
+        Path of data that exists already instead of being produced by a command, see `data`
+    code : str, optional
+        Hash of the code that runs the command, see `code_hash`, so that results of older code are not reused
+    """
+
+    def __init__(self, name: str, args: List[Union[str, Tuple[Optional['Step'], str]]] = (), path: str = None,
+                 code: str = None):
+        self.name = name
+        self._args = list(args)
+        self.path = path
+        self.code = code
+        self.key = self._hash()
+
+    @classmethod
+    def data(cls, name: str, path: str) -> 'Step':
+        """Existing input file, hashed by its content."""
+        return cls(name, path=os.path.abspath(path))
+
+    @property
+    def parents(self) -> List['Step']:
+        return [arg[0] for arg in self._args if isinstance(arg, tuple) and arg[0] is not None]
+
+    def directory(self, cache_dir: str) -> str:
+        return os.path.join(cache_dir, f'{self.name}-{self.key[:16]}')
+
+    def output(self, cache_dir: str, name: str) -> str:
+        return self.path if self.path else os.path.join(self.directory(cache_dir), name)
+
+    def is_done(self, cache_dir: str) -> bool:
+        return self.path is not None or os.path.isdir(self.directory(cache_dir))
+
+    def args(self, cache_dir: str, output_dir: str) -> List[str]:
+        """chem-util arguments, with outputs written to output_dir."""
+        return [arg if isinstance(arg, str) else
+                os.path.join(output_dir, arg[1]) if arg[0] is None else arg[0].output(cache_dir, arg[1])
+                for arg in self._args]
+
+    def _hash(self) -> str:
+        digest = hashlib.sha256()
+        if self.path:
+            with open(self.path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+        else:
+            digest.update(json.dumps([self.code, [arg if isinstance(arg, str) else [arg[0] and arg[0].key, arg[1]]
+                                                  for arg in self._args]]).encode())
+        return digest.hexdigest()
+
+
+@lru_cache()
+def code_hash(chem_util: str = CHEM_UTIL) -> str:
+    """Hash of chem-util.py and the Python files of its `src` package."""
+    root = os.path.dirname(os.path.abspath(chem_util))
+    digest = hashlib.sha256()
+    for path in [os.path.abspath(chem_util)] + sorted(glob.glob(os.path.join(root, 'src', '**', '*.py'),
+                                                                recursive=True)):
+        with open(path, 'rb') as f:
+            digest.update(os.path.relpath(path, root).encode() + b'\0' + f.read() + b'\0')
+    return digest.hexdigest()
+
+
+def _run_chem_util(chem_util: str, args: List[str]) -> None:
+    """Runs a chem-util command in this (worker) process."""
+    global _chem_util
+    if _chem_util is None:
+        # chem-util imports its `src` package relative to its own directory
+        sys.path.insert(0, os.path.dirname(os.path.abspath(chem_util)))
+        spec = importlib.util.spec_from_file_location('chem_util', chem_util)
+        _chem_util = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(_chem_util)
+    _chem_util.cli.main(args=args, standalone_mode=False)
+
+
+def compile_pipeline(pipeline_func: Callable) -> Dict:
+    """Compiles a pipeline of `pipeline.py` into its pipeline spec, the YAML that is uploaded to Kubeflow."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'pipeline.yaml')
+        compiler.Compiler().compile(pipeline_func, path)
+        with open(path) as f:
+            return yaml.safe_load(f)
+
+
+def pipeline_steps(spec: Dict, arguments: Dict[str, Any], input_data: str, steps: Dict[str, Step] = None,
+                   chem_util: str = CHEM_UTIL) -> Dict[str, Step]:
+    """Adds the chem-util steps of a compiled pipeline to steps and returns them by task name.
+
+    The importer reads input_data instead of its artifact URI and tasks that do not run chem-util.py (e.g.
+    report_metric) are left out. Steps with the same hash are only added once, so several parameter sets share
+    their common steps.
+    """
+    steps = {} if steps is None else steps
+    code = code_hash(chem_util)
+    tasks = spec['root']['dag']['tasks']
+    by_task, left_out = {}, set()
+
+    def resolve(task_name, inputs, arg):
+        match = PLACEHOLDER.fullmatch(arg)
+        if match is None:
+            if '{{$' in arg:
+                raise click.UsageError(f"Argument {arg} of task {task_name} is not supported locally.")
+            return arg
+        io, kind, name = match.groups()
+        if io == 'outputs':
+            return None, name
+        if kind == 'artifacts':
+            source = inputs['artifacts'][name]['taskOutputArtifact']
+            if source['producerTask'] not in by_task:
+                raise click.UsageError(f"Task {task_name} needs an output of {source['producerTask']}, which does "
+                                       f"not run locally.")
+            return by_task[source['producerTask']], source['outputArtifactKey']
+        source = inputs['parameters'][name]
+        if 'componentInputParameter' in source:
+            return str(arguments[source['componentInputParameter']])
+        if 'runtimeValue' in source:
+            return str(source['runtimeValue']['constant'])
+        raise click.UsageError(f"Parameter {name} of task {task_name} is not supported locally.")
+
+    while len(by_task) + len(left_out) < len(tasks):
+        ready = [name for name, task in tasks.items() if name not in by_task and name not in left_out and
+                 all(parent in by_task or parent in left_out for parent in task.get('dependentTasks', []))]
+        for name in ready:
+            task = tasks[name]
+            component = spec['components'][task['componentRef']['name']]
+            if 'dag' in component:
+                raise click.UsageError(f"Task {name} is a nested DAG (e.g. dsl.ParallelFor), which is not supported "
+                                       f"locally.")
+            executor = spec['deploymentSpec']['executors'][component['executorLabel']]
+            if 'importer' in executor:
+                step = Step.data(name, input_data)
+            elif executor['container'].get('command', [])[-1:] == ['chem-util.py']:
+                inputs = task.get('inputs', {})
+                step = Step(name, [resolve(name, inputs, arg) for arg in executor['container']['args']], code=code)
+            else:
+                left_out.add(name)
+                continue
+            by_task[name] = steps.setdefault(step.key, step)
+    return by_task
+
+
+def run(steps: List[Step], cache_dir: str, workers: Optional[int] = None, chem_util: str = CHEM_UTIL) -> Dict:
+    """Runs the steps that have no results yet, each as soon as its parents are done.
+
+    Returns
+    -------
+    Dict
+        Steps by outcome: `cached`, `done` and `failed`, and `skipped` for steps whose parents failed
+    """
+    outcome = {'cached': [], 'done': [], 'failed': [], 'skipped': []}
+    remaining = []
+    for step in steps:
+        (outcome['cached'] if step.is_done(cache_dir) else remaining).append(step)
+    for step in outcome['cached']:
+        if step.path is None:
+            print(f"Reusing {step.name} from {step.directory(cache_dir)}")
+    running = {}
+    with ProcessPoolExecutor(workers) as executor:
+        while remaining or running:
+            for step in list(remaining):
+                if any(parent in outcome['failed'] or parent in outcome['skipped'] for parent in step.parents):
+                    remaining.remove(step)
+                    outcome['skipped'].append(step)
+                elif all(parent.is_done(cache_dir) for parent in step.parents):
+                    remaining.remove(step)
+                    # outputs are moved into place only once the command succeeded
+                    tmp_dir = f'{step.directory(cache_dir)}.tmp'
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    os.makedirs(tmp_dir)
+                    print(f"Running {step.name}: {' '.join(step.args(cache_dir, tmp_dir))}")
+                    running[executor.submit(_run_chem_util, chem_util, step.args(cache_dir, tmp_dir))] = \
+                        (step, tmp_dir)
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step, tmp_dir = running.pop(future)
+                try:
+                    future.result()
+                except (Exception, SystemExit) as e:
+                    print(f"{step.name} failed: {e!r}")
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    outcome['failed'].append(step)
+                    continue
+                os.replace(tmp_dir, step.directory(cache_dir))
+                outcome['done'].append(step)
+    return outcome
+
+
+@click.command(help=__doc__)
+@click.option('--input-data', '-i', help="Path to the input data (csv.zip).", required=True, type=str)
+@click.option('--n-bits', '-n', help="Number of fingerprint bits, can be repeated to run one pipeline each.",
+              multiple=True, type=int, default=[1024])
+@click.option('--n-trees', '-t', help="Number of trees, can be repeated to run one pipeline each.", multiple=True,
+              type=int, default=[16])
+@click.option('--cache-dir', '-c', help="Directory of the step results, reused across runs.", type=str,
+              default=os.path.expanduser('~/.cache/chem-pipeline'))
+@click.option('--workers', '-w', help="Number of steps run at once, defaults to all cores.", type=int)
+@click.option('--chem-util', help="Path to chem-util.py.", type=str, default=CHEM_UTIL)
+def main(input_data, n_bits, n_trees, cache_dir, workers, chem_util):
+    os.makedirs(cache_dir, exist_ok=True)
+    spec = compile_pipeline(pipeline.chem_classification_pipeline)
+    steps = {}
+    runs = {(bits, trees): pipeline_steps(spec, {'n_bits': bits, 'n_trees': trees}, input_data, steps,
+                                          chem_util)['evaluate']
+            for bits, trees in product(n_bits, n_trees)}
+    outcome = run(list(steps.values()), cache_dir, workers, chem_util)
+    # input data counts as a step, but is never run
+    reused = [step for step in outcome['cached'] if step.path is None]
+    print(f"{len(outcome['done'])} steps run, {len(reused)} reused, {len(outcome['failed'])} failed, "
+          f"{len(outcome['skipped'])} skipped")
+    for (bits, trees), evaluation in runs.items():
+        if evaluation.is_done(cache_dir):
+            with open(evaluation.output(cache_dir, 'metric')) as f:
+                print(f"n_bits={bits} n_trees={trees}: ROC AUC {f.read()}")
+        else:
+            print(f"n_bits={bits} n_trees={trees}: failed")
+    sys.exit(1 if outcome['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,70 @@
+import json
+import logging
+import os
 import re
+import tempfile
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from typing import Optional
 from urllib.parse import urlsplit
 
+# cached session cookies by endpoint and user, see `get_istio_auth_session`
+logger = logging.getLogger(__name__)
 
-def get_istio_auth_session(url: str, username: str, password: str) -> dict:
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "kubeflow", "auth_sessions.json")
+# cookies that expire within this many seconds are not reused
+EXPIRY_MARGIN = 60
+
+
+def get_istio_auth_session(url: str, username: str, password: str, cache_path: Optional[str] = DEFAULT_CACHE_PATH,
+                           pooled_session: bool = False, pool_size: int = 10) -> dict:
     """
     Determine if the specified URL is secured by Dex and try to obtain a session cookie.
     WARNING: only Dex `staticPasswords` and `LDAP` authentication are currently supported
              (we default to using `staticPasswords` if both are enabled)
 
+    The session cookie is kept in a local cache file keyed by endpoint and user. A cached cookie is reused as long
+    as it has not expired and the endpoint still accepts it, otherwise the full Dex login is done again.
+
     :param url: Kubeflow server URL, including protocol
     :param username: Dex `staticPasswords` or `LDAP` username
     :param password: Dex `staticPasswords` or `LDAP` password
+    :param cache_path: path of the cookie cache file (only readable by the user), None to always log in
+    :param pooled_session: if True, the returned information includes a `requests.Session` under "session", which
+                           carries the session cookies and keeps up to `pool_size` connections per host open
+    :param pool_size: maximum number of pooled connections per host of the returned session
     :return: auth session information
     """
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    try:
+        auth_session = _get_cached_session(s, cache_path, url, username) if cache_path else None
+        if auth_session is None:
+            auth_session = _login(s, url, username, password)
+            if cache_path and auth_session["is_secured"]:
+                try:
+                    _cache_session(s, cache_path, username, auth_session)
+                except OSError as e:
+                    # e.g. a read-only home directory, the login itself succeeded
+                    logger.warning(f"Could not cache the session cookies in {cache_path}: {e}")
+    except Exception:
+        s.close()
+        raise
+    if pooled_session:
+        s.verify = False
+        auth_session["session"] = s
+    else:
+        s.close()
+    return auth_session
+
+
+def _login(s: requests.Session, url: str, username: str, password: str) -> dict:
+    """
+    Do the full Dex login with the given session, which keeps the resulting cookies.
+    """
     # define the default return object
     auth_session = {
         "endpoint_url": url,  # KF endpoint URL
@@ -23,78 +74,132 @@ def get_istio_auth_session(url: str, username: str, password: str) -> dict:
         "session_cookie": None  # Resulting session cookies in the form "key1=value1; key2=value2"
     }
 
-    # use a persistent session (for cookies)
-    with requests.Session() as s:
+    ################
+    # Determine if Endpoint is Secured
+    ################
+    resp = s.get(url, allow_redirects=True, verify=False)
+    if resp.status_code != 200:
+        raise RuntimeError(
+            f"HTTP status code '{resp.status_code}' for GET against: {url}"
+        )
 
-        ################
-        # Determine if Endpoint is Secured
-        ################
-        resp = s.get(url, allow_redirects=True, verify=False)
+    auth_session["redirect_url"] = resp.url
+
+    # if we were NOT redirected, then the endpoint is UNSECURED
+    if len(resp.history) == 0:
+        auth_session["is_secured"] = False
+        return auth_session
+    else:
+        auth_session["is_secured"] = True
+
+    ################
+    # Get Dex Login URL
+    ################
+    redirect_url_obj = urlsplit(auth_session["redirect_url"])
+
+    # if we are at `/auth?=xxxx` path, we need to select an auth type
+    if re.search(r"/auth$", redirect_url_obj.path):
+        #######
+        # TIP: choose the default auth type by including ONE of the following
+        #######
+
+        # OPTION 1: set "staticPasswords" as default auth type
+        redirect_url_obj = redirect_url_obj._replace(
+            path=re.sub(r"/auth$", "/auth/local", redirect_url_obj.path)
+        )
+        # OPTION 2: set "ldap" as default auth type
+        # redirect_url_obj = redirect_url_obj._replace(
+        #     path=re.sub(r"/auth$", "/auth/ldap", redirect_url_obj.path)
+        # )
+
+    # if we are at `/auth/xxxx/login` path, then no further action is needed (we can use it for login POST)
+    if re.search(r"/auth/.*/login$", redirect_url_obj.path):
+        auth_session["dex_login_url"] = redirect_url_obj.geturl()
+
+    # else, we need to be redirected to the actual login page
+    else:
+        # this GET should redirect us to the `/auth/xxxx/login` path
+        resp = s.get(redirect_url_obj.geturl(), allow_redirects=True, verify=False)
         if resp.status_code != 200:
             raise RuntimeError(
-                f"HTTP status code '{resp.status_code}' for GET against: {url}"
+                f"HTTP status code '{resp.status_code}' for GET against: {redirect_url_obj.geturl()}"
             )
 
-        auth_session["redirect_url"] = resp.url
-
-        # if we were NOT redirected, then the endpoint is UNSECURED
-        if len(resp.history) == 0:
-            auth_session["is_secured"] = False
-            return auth_session
-        else:
-            auth_session["is_secured"] = True
-
-        ################
-        # Get Dex Login URL
-        ################
-        redirect_url_obj = urlsplit(auth_session["redirect_url"])
-
-        # if we are at `/auth?=xxxx` path, we need to select an auth type
-        if re.search(r"/auth$", redirect_url_obj.path):
-            #######
-            # TIP: choose the default auth type by including ONE of the following
-            #######
-
-            # OPTION 1: set "staticPasswords" as default auth type
-            redirect_url_obj = redirect_url_obj._replace(
-                path=re.sub(r"/auth$", "/auth/local", redirect_url_obj.path)
-            )
-            # OPTION 2: set "ldap" as default auth type
-            # redirect_url_obj = redirect_url_obj._replace(
-            #     path=re.sub(r"/auth$", "/auth/ldap", redirect_url_obj.path)
-            # )
-
-        # if we are at `/auth/xxxx/login` path, then no further action is needed (we can use it for login POST)
-        if re.search(r"/auth/.*/login$", redirect_url_obj.path):
-            auth_session["dex_login_url"] = redirect_url_obj.geturl()
-
-        # else, we need to be redirected to the actual login page
-        else:
-            # this GET should redirect us to the `/auth/xxxx/login` path
-            resp = s.get(redirect_url_obj.geturl(), allow_redirects=True, verify=False)
-            if resp.status_code != 200:
-                raise RuntimeError(
-                    f"HTTP status code '{resp.status_code}' for GET against: {redirect_url_obj.geturl()}"
-                )
-
-            # set the login url
-            auth_session["dex_login_url"] = resp.url
-
-        ################
-        # Attempt Dex Login
-        ################
-        resp = s.post(
-            auth_session["dex_login_url"],
-            data={"login": username, "password": password},
-            allow_redirects=True
+        # set the login url
+        auth_session["dex_login_url"] = resp.url
+
+    ################
+    # Attempt Dex Login
+    ################
+    resp = s.post(
+        auth_session["dex_login_url"],
+        data={"login": username, "password": password},
+        allow_redirects=True
+    )
+    if len(resp.history) == 0:
+        raise RuntimeError(
+            f"Login credentials were probably invalid - "
+            f"No redirect after POST to: {auth_session['dex_login_url']}"
         )
-        if len(resp.history) == 0:
-            raise RuntimeError(
-                f"Login credentials were probably invalid - "
-                f"No redirect after POST to: {auth_session['dex_login_url']}"
-            )
 
-        # store the session cookies in a "key1=value1; key2=value2" string
-        auth_session["session_cookie"] = "; ".join([f"{c.name}={c.value}" for c in s.cookies])
+    # store the session cookies in a "key1=value1; key2=value2" string
+    auth_session["session_cookie"] = "; ".join([f"{c.name}={c.value}" for c in s.cookies])
 
     return auth_session
+
+
+def _cache_key(url: str, username: str) -> str:
+    return f"{username}@{url}"
+
+
+def _read_cache(cache_path: str) -> dict:
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _get_cached_session(s: requests.Session, cache_path: str, url: str, username: str) -> Optional[dict]:
+    """
+    Load the cached cookies of endpoint and user into the session if they have not expired and are still accepted.
+
+    :return: the cached auth session information, None if there is no usable cached session
+    """
+    cached = _read_cache(cache_path).get(_cache_key(url, username))
+    if cached is None:
+        return None
+    if cached["expires"] is not None and cached["expires"] < time.time() + EXPIRY_MARGIN:
+        return None
+    for cookie in cached["cookies"]:
+        s.cookies.set(**cookie)
+    # an accepted cookie gets the endpoint without a redirect to the login page
+    resp = s.get(url, allow_redirects=True, verify=False)
+    if resp.status_code != 200 or len(resp.history) > 0:
+        s.cookies.clear()
+        return None
+    return cached["auth_session"]
+
+
+def _cache_session(s: requests.Session, cache_path: str, username: str, auth_session: dict) -> None:
+    """
+    Store the session cookies, replacing the cache file atomically. The file is only readable by the user.
+    """
+    cookies = [{"name": c.name, "value": c.value, "domain": c.domain, "path": c.path, "expires": c.expires}
+               for c in s.cookies]
+    expires = [c["expires"] for c in cookies if c["expires"] is not None]
+    cache = _read_cache(cache_path)
+    cache[_cache_key(auth_session["endpoint_url"], username)] = {
+        "auth_session": auth_session,
+        "cookies": cookies,
+        "expires": min(expires) if expires else None,  # None for cookies that last for the browser session
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_path)))
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise